@@ -0,0 +1,150 @@
+"""
+A local OpenAI compatible server (POST /v1/chat/completions) for benchmarks, with configurable
+latency, error rate and 429 injection. Run it standalone with
+    python -m benchmarks.mock_server --port 8000 --latency_secs 0.2 --rate_limit_rate 0.05
+or start it in process with MockServer(...).start().
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_secs: float = 0.0,
+                 latency_jitter_secs: float = 0.0, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 retry_after_secs: float = 0.05, seed: int = 0):
+        self.latency_secs = latency_secs
+        self.latency_jitter_secs = latency_jitter_secs
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_secs = retry_after_secs
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0, "completions": 0}
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def configure(self, **settings):
+        """Changes latency_secs, error_rate, rate_limit_rate, .. of the running server."""
+        for name, value in settings.items():
+            assert hasattr(self, name), f"mock server: unknown setting {name}."
+            setattr(self, name, value)
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = dict.fromkeys(self.stats, 0)
+
+    def start(self) -> "MockServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _outcome(self) -> str:
+        with self._lock:
+            self.stats["requests"] += 1
+            draw = self._random.random()
+            delay = self.latency_secs + self._random.uniform(0, self.latency_jitter_secs)
+            if draw < self.rate_limit_rate:
+                outcome = "rate_limited"
+            elif draw < self.rate_limit_rate + self.error_rate:
+                outcome = "errors"
+            else:
+                outcome = "completions"
+            self.stats[outcome] += 1
+        if outcome != "rate_limited":
+            time.sleep(delay)
+        return outcome
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status: int, body: dict, headers: dict = None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.endswith("/chat/completions"):
+                    return self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+                outcome = server._outcome()
+                if outcome == "rate_limited":
+                    return self._send_json(429, {"error": {"message": "rate limited", "type": "rate_limit_error"}},
+                                           headers={"retry-after-ms": str(int(server.retry_after_secs * 1000))})
+                if outcome == "errors":
+                    return self._send_json(500, {"error": {"message": "injected error", "type": "server_error"}})
+                content = "mock answer to: " + str(request.get("messages", [{}])[-1].get("content", ""))[:40]
+                if request.get("stream"):
+                    return self._stream(request, content)
+                n = int(request.get("n") or 1)
+                prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in request.get("messages", []))
+                self._send_json(200, {
+                    "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()),
+                    "model": request.get("model", "mock"),
+                    "choices": [{"index": i, "message": {"role": "assistant", "content": f"{content} #{i}"},
+                                 "finish_reason": "stop"} for i in range(n)],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 8 * n,
+                              "total_tokens": prompt_tokens + 8 * n},
+                })
+
+            def _stream(self, request: dict, content: str):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for word in content.split(" ") + [None]:
+                    chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()),
+                             "model": request.get("model", "mock"),
+                             "choices": [{"index": 0, "delta": {"content": f"{word} "} if word else {},
+                                          "finish_reason": None if word else "stop"}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency_secs", type=float, default=0.0)
+    parser.add_argument("--latency_jitter_secs", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--rate_limit_rate", type=float, default=0.0)
+    parser.add_argument("--retry_after_secs", type=float, default=0.05)
+    args = parser.parse_args()
+    server = MockServer(**vars(args))
+    print(f"Serving an OpenAI compatible api at {server.base_url}")
+    server.httpd.serve_forever()
@@ -0,0 +1,278 @@
+"""
+Benchmarks of gptinference itself, against a local mock server (see benchmarks/mock_server.py):
+cache load/get/save at several sizes, call overhead, call_batch throughput at several concurrencies,
+retries under injected errors and 429s, failover between two routed providers (one failing) and
+routing to the faster of two providers. Results are written as json and can be compared with an
+earlier run:
+    python -m benchmarks.run_benchmarks --out bench.json
+    python -m benchmarks.run_benchmarks --out bench_new.json --compare bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from benchmarks.mock_server import MockServer
+from gptinference.caching import Caching, OpenAICacheKey, OpenAICacheValue, encode_record
+from gptinference.metrics import Metrics, price_of, set_price
+from gptinference.openai_api import get_client, register_provider, set_engine_provider
+from gptinference.openai_wrapper import OpenAIWrapper
+from gptinference.retry_policy import RetryPolicy
+from gptinference.routing import add_route, router
+
+ENGINE = "gpt-3.5-turbo"
+# a logical engine served by two mock providers, see bench_failover.
+ROUTED_ENGINE = "mock-routed"
+NEVER = 10 ** 9  # no background saves while timing.
+
+
+def timed(fn: Callable) -> float:
+    started_at = time.perf_counter()
+    fn()
+    return time.perf_counter() - started_at
+
+
+def mk_key(i: int, prompt_len: int = 200) -> OpenAICacheKey:
+    prompt = f"Question {i}: " + ("lorem ipsum " * (prompt_len // 12 + 1))[:prompt_len]
+    return OpenAICacheKey(engine=ENGINE, prompt=prompt, stop_token="###", temperature=0.0)
+
+
+def mk_cache_file(path: str, size: int):
+    with open(path, 'wb') as f:
+        for i in range(size):
+            f.write(encode_record(mk_key(i), OpenAICacheValue(first_response=f"answer {i}")))
+
+
+def bench_cache(sizes: List[int], tmp_dir: str, num_ops: int) -> List[Dict]:
+    results = []
+    for size in sizes:
+        path = os.path.join(tmp_dir, f"cache_{size}.jsonl")
+        mk_cache_file(path, size)
+        file_mb = os.path.getsize(path) / 1e6
+        for lazy in (False, True):
+            params = {"size": size, "lazy": lazy}
+            holder = {}
+            load_secs = timed(lambda: holder.update(cache=Caching(cache_path=path, lazy=lazy, save_every_n_seconds=NEVER,
+                                                                  save_every_n_entries=NEVER)))
+            cache = holder["cache"]
+            results.append({"benchmark": "cache_load", "params": params, "secs": load_secs,
+                            "entries_per_sec": size / load_secs if load_secs else 0.0, "file_mb": file_mb})
+
+            keys = [mk_key(random.randrange(size)) for _ in range(min(size, num_ops))]
+            get_secs = timed(lambda: [cache.get(k) for k in keys])
+            results.append({"benchmark": "cache_get", "params": params, "ops": len(keys),
+                            "us_per_op": 1e6 * get_secs / len(keys)})
+
+            new_entries = [(mk_key(size + i), OpenAICacheValue(first_response=f"new answer {i}"))
+                           for i in range(min(size, num_ops))]
+            set_secs = timed(lambda: [cache.set(k, v) for k, v in new_entries])
+            save_secs = timed(cache.save_cache)
+            results.append({"benchmark": "cache_set_save", "params": params, "ops": len(new_entries),
+                            "set_us_per_op": 1e6 * set_secs / len(new_entries), "save_secs": save_secs})
+            cache.cleanup()
+            # the next variant loads the same entries as this one.
+            mk_cache_file(path, size)
+        os.remove(path)
+    return results
+
+
+def mk_wrapper(tmp_dir: str, name: str, **kwargs) -> OpenAIWrapper:
+    return OpenAIWrapper(cache_path=os.path.join(tmp_dir, f"{name}.jsonl"), save_every_n_seconds=NEVER,
+                         save_every_n_entries=NEVER, **kwargs)
+
+
+def bench_call(server: MockServer, tmp_dir: str, num_calls: int) -> List[Dict]:
+    """Per call time of a raw client request, of OpenAIWrapper.call on a miss and on a hit (latency 0),
+    the difference being the overhead of the wrapper."""
+    server.configure(latency_secs=0.0, error_rate=0.0, rate_limit_rate=0.0)
+    client = get_client(engine=ENGINE)
+    messages = [[{"role": "user", "content": f"raw prompt {i}"}] for i in range(num_calls)]
+    raw_secs = timed(lambda: [client.chat.completions.create(model=ENGINE, messages=m, max_tokens=10) for m in messages])
+    wrapper = mk_wrapper(tmp_dir, "call")
+    prompts = [f"call prompt {i}" for i in range(num_calls)]
+    miss_secs = timed(lambda: [wrapper.call(p, engine=ENGINE) for p in prompts])
+    hit_secs = timed(lambda: [wrapper.call(p, engine=ENGINE) for p in prompts])
+    wrapper.cache.cleanup()
+    return [{"benchmark": "call", "params": {"num_calls": num_calls},
+             "raw_client_ms_per_call": 1e3 * raw_secs / num_calls,
+             "miss_ms_per_call": 1e3 * miss_secs / num_calls,
+             "hit_us_per_call": 1e6 * hit_secs / num_calls,
+             "miss_overhead_ms_per_call": 1e3 * (miss_secs - raw_secs) / num_calls}]
+
+
+def bench_call_batch(server: MockServer, tmp_dir: str, concurrencies: List[int], num_prompts: int,
+                     latency_secs: float) -> List[Dict]:
+    server.configure(latency_secs=latency_secs, error_rate=0.0, rate_limit_rate=0.0)
+    results = []
+    for concurrency in concurrencies:
+        wrapper = mk_wrapper(tmp_dir, f"batch_{concurrency}")
+        prompts = [f"batch prompt {concurrency} {i}" for i in range(num_prompts)]
+        secs = timed(lambda: wrapper.call_batch(prompts, engine=ENGINE, max_concurrency=concurrency))
+        results.append({"benchmark": "call_batch", "params": {"concurrency": concurrency, "num_prompts": num_prompts,
+                                                              "latency_secs": latency_secs},
+                        "secs": secs, "prompts_per_sec": num_prompts / secs,
+                        # the best possible with this latency and concurrency.
+                        "efficiency": (num_prompts / secs) / (concurrency / latency_secs) if latency_secs else None})
+        wrapper.cache.cleanup()
+    return results
+
+
+def bench_retries(server: MockServer, tmp_dir: str, num_prompts: int, concurrency: int, error_rate: float,
+                  rate_limit_rate: float, latency_secs: float) -> List[Dict]:
+    server.configure(latency_secs=latency_secs, error_rate=error_rate, rate_limit_rate=rate_limit_rate)
+    server.reset_stats()
+    policy = RetryPolicy(initial_delay_secs=0.01, max_delay_secs=0.2)
+    metrics = Metrics()
+    wrapper = mk_wrapper(tmp_dir, "retries", retry_policy=policy, metrics=metrics)
+    prompts = [f"retry prompt {i}" for i in range(num_prompts)]
+    num_failures = 0
+
+    def run():
+        nonlocal num_failures
+        try:
+            wrapper.call_batch(prompts, engine=ENGINE, max_concurrency=concurrency)
+        except Exception:
+            num_failures += 1
+
+    secs = timed(run)
+    wrapper.cache.cleanup()
+    api_latency = metrics.snapshot().get(ENGINE, {}).get("api_latency_secs", {})
+    return [{"benchmark": "retries", "params": {"num_prompts": num_prompts, "concurrency": concurrency,
+                                                "error_rate": error_rate, "rate_limit_rate": rate_limit_rate,
+                                                "latency_secs": latency_secs},
+             "secs": secs, "failed_batches": num_failures, "server": dict(server.stats),
+             "retry_policy": policy.get_stats(),
+             "mean_api_secs": api_latency["sum"] / api_latency["count"] if api_latency.get("count") else None}]
+
+
+def bench_failover(tmp_dir: str, num_prompts: int, concurrency: int, latency_secs: float) -> List[Dict]:
+    """A logical engine routed to two mock providers, the first of which always fails with a 500:
+    every call must succeed through the healthy one, the failing one being ranked last after its
+    first errors."""
+    with MockServer(latency_secs=latency_secs) as healthy, MockServer(error_rate=1.0, seed=1) as failing:
+        register_provider("mock_healthy", base_url=healthy.base_url, api_key="mock", client_max_retries=0)
+        register_provider("mock_failing", base_url=failing.base_url, api_key="mock", client_max_retries=0)
+        add_route(ROUTED_ENGINE, [("mock_failing", ENGINE), ("mock_healthy", ENGINE)])
+        set_price(ROUTED_ENGINE, **{f"{name}_per_million": p for name, p in price_of(ENGINE).items()})
+        wrapper = mk_wrapper(tmp_dir, "failover", retry_policy=RetryPolicy(initial_delay_secs=0.01, max_delay_secs=0.2))
+        prompts = [f"failover prompt {i}" for i in range(num_prompts)]
+        holder = {}
+        secs = timed(lambda: holder.update(responses=wrapper.call_batch(prompts, engine=ROUTED_ENGINE,
+                                                                        max_concurrency=concurrency)))
+        wrapper.cache.cleanup()
+        num_answered = sum(1 for r in holder["responses"] if r and r.startswith("mock answer"))
+        assert num_answered == num_prompts, f"failover: only {num_answered} of {num_prompts} prompts were answered."
+        return [{"benchmark": "failover", "params": {"num_prompts": num_prompts, "concurrency": concurrency,
+                                                     "latency_secs": latency_secs},
+                 "secs": secs, "prompts_per_sec": num_prompts / secs,
+                 "healthy_server": dict(healthy.stats), "failing_server": dict(failing.stats),
+                 "endpoints": router.stats()[ROUTED_ENGINE]}]
+
+
+def bench_routing(tmp_dir: str, num_prompts: int, concurrency: int, latency_secs: float) -> List[Dict]:
+    """A logical engine routed to a slow mock provider (listed first) and one 10x faster: the router
+    must find the fast one by exploring and send it most of the requests."""
+    with MockServer(latency_secs=10 * latency_secs) as slow, MockServer(latency_secs=latency_secs) as fast:
+        register_provider("mock_slow", base_url=slow.base_url, api_key="mock", client_max_retries=0)
+        register_provider("mock_fast", base_url=fast.base_url, api_key="mock", client_max_retries=0)
+        add_route(ROUTED_ENGINE, [("mock_slow", ENGINE), ("mock_fast", ENGINE)])
+        set_price(ROUTED_ENGINE, **{f"{name}_per_million": p for name, p in price_of(ENGINE).items()})
+        wrapper = mk_wrapper(tmp_dir, "routing")
+        prompts = [f"routing prompt {i}" for i in range(num_prompts)]
+        secs = timed(lambda: wrapper.call_batch(prompts, engine=ROUTED_ENGINE, max_concurrency=concurrency))
+        wrapper.cache.cleanup()
+        fast_share = fast.stats["completions"] / num_prompts
+        assert fast_share > 0.5, f"routing: only {fast_share:.0%} of the requests went to the fastest endpoint."
+        return [{"benchmark": "routing", "params": {"num_prompts": num_prompts, "concurrency": concurrency,
+                                                    "latency_secs": latency_secs},
+                 "secs": secs, "prompts_per_sec": num_prompts / secs, "fast_share": fast_share,
+                 "slow_server": dict(slow.stats), "fast_server": dict(fast.stats),
+                 "endpoints": router.stats()[ROUTED_ENGINE]}]
+
+
+def metadata() -> Dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def compare(old: Dict, new: Dict):
+    """Prints new / old for every number of the results the two runs share."""
+    old_results = {(r["benchmark"], json.dumps(r["params"], sort_keys=True)): r for r in old["results"]}
+    print(f"\n{new['meta'].get('commit')} vs {old['meta'].get('commit')} (new / old):")
+    for r in new["results"]:
+        previous = old_results.get((r["benchmark"], json.dumps(r["params"], sort_keys=True)))
+        if previous is None:
+            continue
+        ratios = [f"{name}={value / previous[name]:.2f}x" for name, value in r.items()
+                  if isinstance(value, (int, float)) and not isinstance(value, bool)
+                  and isinstance(previous.get(name), (int, float)) and previous[name]]
+        print(f"  {r['benchmark']} {r['params']}: {', '.join(ratios)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default="bench.json", help="where to write the json results.")
+    parser.add_argument("--compare", default=None, help="json results of an earlier run to compare with.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="cache sizes.")
+    parser.add_argument("--num_ops", type=int, default=10000, help="gets and sets per cache size.")
+    parser.add_argument("--num_calls", type=int, default=200)
+    parser.add_argument("--concurrencies", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--num_prompts", type=int, default=256)
+    parser.add_argument("--latency_secs", type=float, default=0.05, help="server latency for call_batch and retries.")
+    parser.add_argument("--error_rate", type=float, default=0.1)
+    parser.add_argument("--rate_limit_rate", type=float, default=0.1)
+    parser.add_argument("--only", nargs="+", default=["cache", "call", "call_batch", "retries", "failover", "routing"])
+    args = parser.parse_args()
+
+    random.seed(0)
+    tmp_dir = tempfile.mkdtemp(prefix="gptinference_bench_")
+    results = []
+    try:
+        if "cache" in args.only:
+            results += bench_cache(args.sizes, tmp_dir, num_ops=args.num_ops)
+        with MockServer() as server:
+            # the raw client requests of bench_call are not retried either, like the wrapper's.
+            register_provider("mock", base_url=server.base_url, api_key="mock", client_max_retries=0)
+            set_engine_provider(ENGINE, "mock")
+            if "call" in args.only:
+                results += bench_call(server, tmp_dir, num_calls=args.num_calls)
+            if "call_batch" in args.only:
+                results += bench_call_batch(server, tmp_dir, args.concurrencies, num_prompts=args.num_prompts,
+                                            latency_secs=args.latency_secs)
+            if "retries" in args.only:
+                results += bench_retries(server, tmp_dir, num_prompts=args.num_prompts, concurrency=16,
+                                         error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                                         latency_secs=args.latency_secs)
+        if "failover" in args.only:
+            results += bench_failover(tmp_dir, num_prompts=args.num_prompts, concurrency=16,
+                                      latency_secs=args.latency_secs)
+        if "routing" in args.only:
+            results += bench_routing(tmp_dir, num_prompts=args.num_prompts, concurrency=4,
+                                     latency_secs=args.latency_secs)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    run = {"meta": metadata(), "results": results}
+    with open(args.out, 'w') as f:
+        json.dump(run, f, indent=2)
+    for r in results:
+        print(json.dumps(r))
+    print(f"\nWrote {len(results)} results to {args.out}")
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), run)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,59 @@
+from typing import Callable, Dict, List, Tuple, Union
+
+Example = Union[str, Dict[str, str], Tuple[str, str]]
+
+DEFAULT_FEW_SHOT_TOKEN_BUDGET = 2000
+_token_counters: Dict[str, Callable[[str], int]] = {}
+
+
+def token_counter(engine: str) -> Callable[[str], int]:
+    """Counts the tokens of a text for engine: with tiktoken if it is installed (and knows the engine),
+    else ~4 characters per token as openai_api.estimate_num_tokens does."""
+    counter = _token_counters.get(engine)
+    if counter is None:
+        try:
+            import tiktoken
+            encoding = tiktoken.encoding_for_model(engine)
+            counter = lambda text: len(encoding.encode(text))
+        except (ImportError, KeyError):
+            counter = lambda text: len(text) // 4 + 1
+        _token_counters[engine] = counter
+    return counter
+
+
+class ExampleBank:
+    """Few-shot examples formatted once by a Prompt (see Prompt.example_bank), with their token counts
+    cached per engine and their words cached for relevance scoring, so that assembling a prompt only
+    picks indices and joins strings."""
+
+    def __init__(self, prompt: "Prompt", examples: List[Example]):
+        self.texts = [prompt.format_example(example) for example in examples]
+        self.inter_example_sep = prompt.inter_example_sep
+        # engine -> token count of every example plus one separator.
+        self._num_tokens: Dict[str, List[int]] = {}
+        self._words = None
+
+    def __len__(self):
+        return len(self.texts)
+
+    def num_tokens(self, engine: str) -> List[int]:
+        num_tokens = self._num_tokens.get(engine)
+        if num_tokens is None:
+            count = token_counter(engine)
+            sep_tokens = count(self.inter_example_sep)
+            num_tokens = self._num_tokens[engine] = [count(text) + sep_tokens for text in self.texts]
+        return num_tokens
+
+    def words(self) -> List[frozenset]:
+        if self._words is None:
+            self._words = [frozenset(text.lower().split()) for text in self.texts]
+        return self._words
+
+    def relevance(self, question: str) -> List[int]:
+        """Number of (lower cased) words every example shares with question."""
+        question_words = frozenset(question.lower().split())
+        return [len(words & question_words) for words in self.words()]
+
 
 class Prompt:
     def __init__(
@@ -5,16 +61,57 @@ class Prompt:
             question_prefix: str="",
             answer_prefix: str="",
             intra_example_sep="\n\n",
-            inter_example_sep="\n\n###\n\n"
+            inter_example_sep="\n\n###\n\n",
+            few_shot_token_budgets: Dict[str, int]=None
     ):
         self.question_prefix = question_prefix
         self.answer_prefix = answer_prefix
         self.intra_example_sep = intra_example_sep
         self.inter_example_sep = inter_example_sep
+        # engine -> max prompt tokens of make_few_shot_query (DEFAULT_FEW_SHOT_TOKEN_BUDGET for other engines).
+        self.few_shot_token_budgets = few_shot_token_budgets or {}
 
     def make_query(self, prompt: str, question: str) -> str:
         return (
             f"{prompt}{self.question_prefix}{question}{self.intra_example_sep}{self.answer_prefix}"
         )
 
+    def format_example(self, example: Example) -> str:
+        """An example is its text, or a (question, answer) pair / {"question": .., "answer": ..} dict
+        formatted like the query."""
+        if isinstance(example, str):
+            return example
+        question, answer = (example["question"], example["answer"]) if isinstance(example, dict) else example
+        return f"{self.question_prefix}{question}{self.intra_example_sep}{self.answer_prefix}{answer}"
+
+    def example_bank(self, examples: List[Example]) -> ExampleBank:
+        """Build once and reuse for every query."""
+        return ExampleBank(self, examples)
+
+    def make_few_shot_query(self, bank: ExampleBank, question: str, engine: str, max_prompt_tokens: int = None,
+                            scores: List[float] = None, by_relevance: bool = True) -> str:
+        """The query for question preceded by as many examples of bank as fit in max_prompt_tokens
+        (by default the engine's few shot budget), joined with inter_example_sep.
 
+        Examples are packed greedily, the highest scores first (scores given per example, else the number
+        of words shared with question if by_relevance, else bank order), skipping those that do not fit.
+        The chosen examples are written in bank order, so the same inputs always give the same prompt
+        (and hit the cache)."""
+        if max_prompt_tokens is None:
+            max_prompt_tokens = self.few_shot_token_budgets.get(engine, DEFAULT_FEW_SHOT_TOKEN_BUDGET)
+        query = Prompt.make_query(self, prompt="", question=question)
+        remaining = max_prompt_tokens - token_counter(engine)(query)
+        if scores is None and by_relevance:
+            scores = bank.relevance(question)
+        order = range(len(bank)) if scores is None else sorted(range(len(bank)), key=lambda i: (-scores[i], i))
+        num_tokens = bank.num_tokens(engine)
+        chosen = []
+        for i in order:
+            if num_tokens[i] <= remaining:
+                chosen.append(i)
+                remaining -= num_tokens[i]
+        if not chosen:
+            return query
+        chosen.sort()
+        sep = bank.inter_example_sep
+        return f"{sep.join([bank.texts[i] for i in chosen])}{sep}{query}"
@@ -0,0 +1,130 @@
+"""
+Offline bulk mode: instead of calling the API prompt by prompt, write the cache misses
+of a list of prompts as a batch request file (the jsonl format of the provider's batch
+endpoint, e.g. https://platform.openai.com/docs/guides/batch), run it offline, and
+ingest the result file into the cache. Later OpenAIWrapper.call's for the same prompts
+are cache hits.
+
+    n = export_batch_requests(wrapper, prompts, engine="gpt-4o", outpath="batch.jsonl")
+    # ... upload batch.jsonl to the batch endpoint, download its output to results.jsonl ...
+    stats = ingest_batch_results(wrapper, results_path="results.jsonl", requests_path="batch.jsonl")
+
+custom_id of every request is the hex digest of its OpenAICacheKey; the keys themselves
+are written next to the request file (<outpath>.keys.jsonl) so the results can be cached
+under them. fake_batch_results produces a result file locally, for tests and dry runs.
+"""
+import json
+from typing import Callable, Dict, List
+
+from gptinference.caching import OpenAICacheKey, OpenAICacheValue
+from gptinference.openai_api import to_chat_messages
+from gptinference.openai_wrapper import OpenAIWrapper, cost_in_dollars
+
+# the batch endpoint is billed at half the price of synchronous requests.
+BATCH_PRICE_DISCOUNT = 0.5
+
+
+def keys_path_of(requests_path: str) -> str:
+    return f"{requests_path}.keys.jsonl"
+
+
+def export_batch_requests(openai_wrapper: OpenAIWrapper, prompts: List, engine: str, outpath: str,
+                          max_tokens=300, stop_token="###", temperature=0.0) -> int:
+    """Writes one batch request per distinct uncached prompt to outpath; returns the number of requests."""
+    num_requests = 0
+    seen = set()
+    with open(outpath, 'w') as requests_file, open(keys_path_of(outpath), 'w') as keys_file:
+        for prompt in prompts:
+            if not prompt:
+                continue
+            cache_key = openai_wrapper.mk_cache_key(prompt=prompt, engine=engine, max_tokens=max_tokens,
+                                                    stop_token=stop_token, temperature=temperature)
+            custom_id = cache_key.digest().hex()
+            if custom_id in seen or openai_wrapper.cache.get(key=cache_key):
+                continue
+            seen.add(custom_id)
+            request = {"custom_id": custom_id,
+                       "method": "POST",
+                       "url": "/v1/chat/completions",
+                       "body": {"model": engine,
+                                "messages": to_chat_messages(prompt),
+                                "temperature": temperature,
+                                "max_tokens": max_tokens,
+                                "top_p": 1,
+                                "stop": [stop_token]}}
+            requests_file.write(json.dumps(request) + "\n")
+            keys_file.write(json.dumps({"custom_id": custom_id, "key": cache_key.to_json()}) + "\n")
+            num_requests += 1
+    return num_requests
+
+
+def ingest_batch_results(openai_wrapper: OpenAIWrapper, results_path: str, requests_path: str) -> Dict:
+    """Caches every successful result of results_path (with its usage) under the key of its custom_id.
+    Returns counts and the token usage / dollar cost of the ingested results."""
+    keys = {}
+    with open(keys_path_of(requests_path)) as f:
+        for line in f:
+            j = json.loads(line)
+            keys[j["custom_id"]] = OpenAICacheKey.from_json(j["key"])
+
+    stats = {"num_ingested": 0, "num_failed": 0, "num_unknown": 0,
+             "input_tokens": 0, "output_tokens": 0, "dollar_cost": 0.0}
+    with open(results_path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            cache_key = keys.get(result.get("custom_id"))
+            response = result.get("response") or {}
+            if cache_key is None:
+                stats["num_unknown"] += 1
+                continue
+            if result.get("error") or response.get("status_code") != 200:
+                stats["num_failed"] += 1
+                continue
+            body = response["body"]
+            all_responses = [str(choice["message"]["content"]) for choice in body["choices"]]
+            usage = body.get("usage") or {}
+            usage = {"prompt_tokens": usage.get("prompt_tokens", 0), "completion_tokens": usage.get("completion_tokens", 0)}
+            openai_wrapper.cache.set(key=cache_key, value=OpenAICacheValue(
+                first_response=all_responses[0], all_responses=all_responses, usage=usage))
+            stats["num_ingested"] += 1
+            stats["input_tokens"] += usage["prompt_tokens"]
+            stats["output_tokens"] += usage["completion_tokens"]
+            try:
+                stats["dollar_cost"] += BATCH_PRICE_DISCOUNT * cost_in_dollars(
+                    num_input_tokens=usage["prompt_tokens"], num_output_tokens=usage["completion_tokens"], engine=cache_key.engine)
+            except ValueError:
+                pass
+    return stats
+
+
+def fake_batch_results(requests_path: str, results_path: str,
+                       respond: Callable[[Dict], str] = None, fail_every_n: int = 0) -> int:
+    """Writes a result file for requests_path as the batch endpoint would, without calling any API.
+    respond(body) gives the completion of a request (by default it echoes the last message);
+    every fail_every_n-th request fails (0: none). Returns the number of results."""
+    respond = respond or (lambda body: f"echo: {body['messages'][-1]['content']}")
+    num_results = 0
+    with open(requests_path) as requests_file, open(results_path, 'w') as results_file:
+        for i, line in enumerate(requests_file):
+            request = json.loads(line)
+            body = request["body"]
+            if fail_every_n and (i + 1) % fail_every_n == 0:
+                result = {"id": f"batch_req_{i}", "custom_id": request["custom_id"], "response": None,
+                          "error": {"code": "server_error", "message": "fake failure"}}
+            else:
+                text = respond(body)
+                prompt_tokens = sum(len(str(m["content"])) for m in body["messages"]) // 4 + 1
+                result = {"id": f"batch_req_{i}", "custom_id": request["custom_id"],
+                          "response": {"status_code": 200, "request_id": f"req_{i}",
+                                       "body": {"object": "chat.completion", "model": body["model"],
+                                                "choices": [{"index": 0, "finish_reason": "stop",
+                                                             "message": {"role": "assistant", "content": text}}],
+                                                "usage": {"prompt_tokens": prompt_tokens,
+                                                          "completion_tokens": len(text) // 4 + 1,
+                                                          "total_tokens": prompt_tokens + len(text) // 4 + 1}}},
+                          "error": None}
+            results_file.write(json.dumps(result) + "\n")
+            num_results += 1
+    return num_results
@@ -1,23 +1,51 @@
+import hashlib
 import json
 import os
+import threading
 import time
-from dataclasses import dataclass, field
-from typing import Dict, List
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
-from gptinference.utils import read_jsonl_or_json, write_txt, write_jsonl
+from gptinference.utils import write_txt
 
 
 import atexit
+from collections import OrderedDict
 
 DEFAULT_MAX_TOKENS = 300
 
-@dataclass
+
+def canonical_prompt(prompt: Union[str, List[str], List[Dict[str, str]]]) -> str:
+    """The prompt as stored in cache keys. Text prompts (or a list holding one) lose their leading
+    whitespace; chat message lists become compact json with sorted keys, so equal conversations
+    give the same key whatever the order of the keys in their messages."""
+    if isinstance(prompt, list) and len(prompt) == 1 and isinstance(prompt[0], str):
+        prompt = prompt[0]
+    if isinstance(prompt, str):
+        return prompt.lstrip()  # don't store new lines in the beginning.
+    return json.dumps(prompt, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def legacy_prompt(prompt) -> str:
+    """How older versions stored a chat message list in cache keys (its python repr)."""
+    return str(prompt).lstrip()
+
 class OpenAICacheKey:
-    engine: str
-    prompt: str
-    stop_token: str
-    temperature: float
-    max_tokens: float = field(default=DEFAULT_MAX_TOKENS)
+    # __slots__ rather than @dataclass(slots=True), which needs python 3.10: there is one key per
+    # cached entry, a per instance __dict__ would cost more than the fields.
+    __slots__ = ("engine", "prompt", "stop_token", "temperature", "max_tokens")
+
+    def __init__(self, engine: str, prompt: str, stop_token: str, temperature: float,
+                 max_tokens: float = DEFAULT_MAX_TOKENS):
+        self.engine = engine
+        self.prompt = prompt
+        self.stop_token = stop_token
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+
+    def __repr__(self):
+        return (f"OpenAICacheKey(engine={self.engine!r}, prompt={self.prompt!r}, stop_token={self.stop_token!r}, "
+                f"temperature={self.temperature!r}, max_tokens={self.max_tokens!r})")
 
     def __eq__(self, other):
         return other and \
@@ -28,6 +56,11 @@ class OpenAICacheKey:
     def __hash__(self):
         return hash((self.engine, self.prompt, self.stop_token, self.temperature, self.max_tokens))
 
+    def digest(self) -> bytes:
+        """Stable 16 byte blake2b digest of the key (unlike hash(), it is the same across processes)."""
+        fields = [self.engine, self.prompt, self.stop_token, float(self.temperature), float(self.max_tokens)]
+        return hashlib.blake2b(json.dumps(fields).encode("utf-8"), digest_size=16).digest()
+
     def to_json(self):
         j = {"engine": self.engine,
                 "prompt": self.prompt,
@@ -51,90 +84,674 @@ class OpenAICacheKey:
         return k
 
 
+class DigestKey:
+    """Stands in for an OpenAICacheKey of which only the digest is known (hashed caches without prompts),
+    and possibly the fields other than the prompt. Backends keyed by digest find its entry."""
+    prompt = None
+
+    def __init__(self, digest: bytes, engine: str = None, stop_token: str = None, temperature: float = None,
+                 max_tokens: float = DEFAULT_MAX_TOKENS):
+        self._digest = digest
+        self.engine = engine
+        self.stop_token = stop_token
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+
+    @staticmethod
+    def of(key: OpenAICacheKey) -> "DigestKey":
+        return DigestKey(key.digest(), engine=key.engine, stop_token=key.stop_token, temperature=key.temperature,
+                         max_tokens=key.max_tokens)
+
+    def digest(self) -> bytes:
+        return self._digest
+
+    def __eq__(self, other):
+        return isinstance(other, DigestKey) and self._digest == other._digest
+
+    def __hash__(self):
+        return hash(self._digest)
+
+
 
 @dataclass
 class OpenAICacheValue:
     first_response: str
+    # every choice of the api call(s) for this key, first_response included
+    # (only written to disk when there is more than one).
+    all_responses: List[str] = None
+    # token usage of the api call, e.g. {"prompt_tokens": 57, "completion_tokens": 17} (optional).
+    usage: Dict[str, int] = None
+    # seconds the api call took (optional); with usage, what a cache hit saves.
+    latency_secs: float = None
+
+    def __post_init__(self):
+        if self.all_responses is None:
+            self.all_responses = [self.first_response]
+
+    @property
+    def num_responses(self) -> int:
+        return len(self.all_responses)
+
     def __eq__(self, other):
         return other and \
-               self.first_response == other.first_response
+               self.first_response == other.first_response and \
+               self.all_responses == other.all_responses
 
     def __hash__(self):
         return hash(self.first_response)
 
     def to_json(self):
-        return {"first_response": self.first_response}
+        j = {"first_response": self.first_response}
+        if len(self.all_responses) > 1:
+            j["all_responses"] = self.all_responses
+        if self.usage:
+            j["usage"] = self.usage
+        if self.latency_secs is not None:
+            j["latency_secs"] = self.latency_secs
+        return j
 
     @staticmethod
     def from_json(d):
         return OpenAICacheValue(
-            first_response=d["first_response"]
+            first_response=d["first_response"],
+            all_responses=d.get("all_responses"),
+            usage=d.get("usage"),
+            latency_secs=d.get("latency_secs")
         )
 
-class Caching:
+def encode_record(key: OpenAICacheKey, value: OpenAICacheValue, hashed_keys=False, keep_prompts=True) -> bytes:
+    """One cache entry per line, encoded once: {"engine": .., "prompt": .., "first_response": ..}
+    With hashed_keys the line holds the key digest ({"key": <hex>, ...}) and the key fields only if keep_prompts."""
+    key_with_value = {"key": key.digest().hex()} if hashed_keys else {}
+    if keep_prompts or not hashed_keys:
+        key_with_value.update(key.to_json())
+    key_with_value.update(value.to_json())
+    return (json.dumps(key_with_value) + "\n").encode("utf-8")
+
+
+def decode_record(line: bytes) -> Dict:
+    j = json.loads(line)
+    # legacy cache files (written by write_jsonl) hold a json string that encodes the record.
+    if isinstance(j, str):
+        j = json.loads(j)
+    return j
+
+
+def record_to_entry(j: Dict) -> Tuple[OpenAICacheKey, OpenAICacheValue]:
+    if "prompt" not in j:
+        raise ValueError("caching: the record only holds a key digest, load the cache with hashed_keys=True.")
+    k = OpenAICacheKey.from_json(j)
+    k.prompt = k.prompt.lstrip()  # strip leading whitespaces.
+    return k, OpenAICacheValue.from_json(j)
+
+
+def record_digest(j: Dict) -> bytes:
+    return bytes.fromhex(j["key"]) if "key" in j else record_to_entry(j)[0].digest()
+
+
+def read_records(fp) -> Iterator[Tuple[int, Dict]]:
+    """Streams (offset, record) from a cache file, one line at a time."""
+    if not os.path.exists(fp) or os.path.getsize(fp) == 0:
+        write_txt(outpath=fp, data_str="")
+        return
+    with open(fp, 'rb') as f:
+        line_num = 0
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            line_num += 1
+            if not line.strip():
+                continue
+            try:
+                yield offset, decode_record(line)
+            except json.JSONDecodeError:
+                # a crash while appending can leave a torn last record; skip it.
+                print(f"\nCaching: skipping unreadable record at line {line_num} of {fp}")
 
-    def __init__(self, cache_path: str, save_every_n_seconds = 600):
 
+def read_line_at(f, offset: int, chunk_size: int = 4096) -> bytes:
+    """The line of file f starting at offset. Uses pread, which does not move a shared file
+    position, so concurrent readers of f need no lock."""
+    chunks = []
+    while True:
+        chunk = os.pread(f.fileno(), chunk_size, offset)
+        end = chunk.find(b"\n")
+        if end >= 0:
+            chunks.append(chunk[:end + 1])
+            return b"".join(chunks)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+        offset += len(chunk)
+
+
+def latest_offsets(fp, key_of) -> Dict:
+    """key_of(record) -> offset of the latest record of that key in fp."""
+    return {key_of(j): offset for offset, j in read_records(fp)}
+
+
+def migrate_cache(src_path: str, dst_path: str, keep_prompts=False):
+    """Rewrites a (legacy or current) cache file with hashed keys, one record per key.
+    Streams src_path twice and only holds digest -> offset in memory."""
+    offsets = latest_offsets(src_path, record_digest)
+    with open(dst_path, 'wb') as out:
+        for offset, j in read_records(src_path):
+            digest = record_digest(j)
+            if offsets.get(digest) != offset:
+                continue
+            key_with_value = {"key": digest.hex()}
+            if keep_prompts and "prompt" in j:
+                key_with_value.update(record_to_entry(j)[0].to_json())
+            key_with_value.update(OpenAICacheValue.from_json(j).to_json())
+            out.write((json.dumps(key_with_value) + "\n").encode("utf-8"))
+    return len(offsets)
+
+
+def merge_caches(src_paths: List[str], dst_path: str) -> int:
+    """Merges cache files (e.g. the shards of a dataset run) into dst_path, one record per key
+    (later files win). Streams every file twice and only holds digest -> location in memory."""
+    latest = {}
+    for i, src_path in enumerate(src_paths):
+        for offset, j in read_records(src_path):
+            latest[record_digest(j)] = (i, offset)
+    with open(dst_path, 'wb') as out:
+        for i, src_path in enumerate(src_paths):
+            for offset, j in read_records(src_path):
+                if latest.get(record_digest(j)) == (i, offset):
+                    out.write((json.dumps(j) + "\n").encode("utf-8"))
+    return len(latest)
+
+
+class CacheBackend:
+    """
+    Storage behind Caching.get/set. `set` only queues the entry (the subclass keeps it
+    readable through `remember`); a background flusher thread hands the queued entries to
+    `write_batch` every save_every_n_seconds or as soon as save_every_n_entries are dirty,
+    so writes never run on the caller's thread.
+    Subclasses implement get, remember, write_batch and num_entries.
+    """
+
+    def __init__(self, save_every_n_seconds = 600, save_every_n_entries: int = 100):
+        self.save_every_n_seconds = save_every_n_seconds
+        self.save_every_n_entries = save_every_n_entries
+        self.cache_started_at = time.time()
+        # entries set but not yet written.
+        self.num_dirty = 0
+        self._pending: List[Tuple[OpenAICacheKey, OpenAICacheValue]] = []
+        self.stats = {"num_flushes": 0, "bytes_written": 0,
+                      "last_flush_secs": 0.0, "max_flush_secs": 0.0, "total_flush_secs": 0.0}
+        # _lock guards the in-memory state and pending entries; _io_lock guards the store.
+        self._lock = threading.RLock()
+        self._io_lock = threading.RLock()
+        self._dirty = threading.Condition(self._lock)
+        self._closed = False
+        self._flusher = None
+
+    def start(self):
+        """Starts the flusher; call at the end of the subclass __init__."""
+        self._flusher = threading.Thread(target=self._run_flusher, daemon=True)
+        self._flusher.start()
         # this function is called twice:
         # https://stackoverflow.com/questions/50142921/prevent-method-from-being-called-twice-in-a-class-that-can-be-called-with-with
         atexit.register(self.cleanup)
 
-        self.save_every_n_seconds = save_every_n_seconds
-        self.cache_started_at = time.time()
-        self.cache: Dict[OpenAICacheKey, OpenAICacheValue] = {}
+    def cleanup(self):
+        # works similar to a destructor but does not offload builtins.open method.
+        print(f"\nFinal cleanup cache saving...", end="...")
+        with self._dirty:
+            self._closed = True
+            self._dirty.notify_all()
+        if self._flusher is not None and self._flusher is not threading.current_thread():
+            self._flusher.join()
+        self.save_cache()
+
+    @property
+    def num_entries(self) -> int:
+        raise NotImplementedError
+
+    def get(self, key: OpenAICacheKey) -> Optional[OpenAICacheValue]:
+        raise NotImplementedError
+
+    def remember(self, key: OpenAICacheKey, value: OpenAICacheValue):
+        """Keeps a set (not yet written) entry readable by get. Called under self._lock."""
+        raise NotImplementedError
+
+    def write_batch(self, entries: List[Tuple[OpenAICacheKey, OpenAICacheValue]]) -> int:
+        """Durably writes the entries (in order, later ones win); returns bytes written."""
+        raise NotImplementedError
+
+    def iter_keys(self) -> Iterator[OpenAICacheKey]:
+        """Streams the keys of the written entries whose prompt is stored (a key may repeat)."""
+        return iter(())
+
+    @property
+    def in_memory(self) -> bool:
+        """Whether get only reads memory (never the disk)."""
+        return False
+
+    @property
+    def stores_prompts(self) -> bool:
+        """Whether prompts are written to disk; if not, neither does the near-duplicate index."""
+        return False
+
+    def after_flush(self):
+        """Runs on the flusher thread after every periodic save (e.g. compaction)."""
+        pass
+
+    def set(self, key, value, verbose=False) -> OpenAICacheValue:
+        with self._dirty:
+            self.remember(key, value)
+            self._pending.append((key, value))
+            self.num_dirty += 1
+            if self.num_dirty >= self.save_every_n_entries:
+                if verbose:
+                    print(f"\nCaching: {self.num_dirty} dirty entries, waking up the flusher ... ")
+                self._dirty.notify()
+        return value
+
+    def _run_flusher(self):
+        while True:
+            with self._dirty:
+                self._dirty.wait_for(lambda: self._closed or self.num_dirty >= self.save_every_n_entries,
+                                     timeout=self.save_every_n_seconds)
+                if self._closed:
+                    return
+            self.save_cache()
+            self.after_flush()
+
+    def save_cache(self, verbose=False):
+        """Writes the dirty entries to the store."""
+        with self._io_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                self.num_dirty = 0
+            if verbose:
+                print(f"\nCaching: Saving openai cache with {len(pending)} new entries", end=" ... ")
+            if not pending:
+                return
+            started_at = time.time()
+            num_bytes = self.write_batch(pending)
+            flush_secs = time.time() - started_at
+            with self._lock:
+                self.stats["num_flushes"] += 1
+                self.stats["bytes_written"] += num_bytes
+                self.stats["last_flush_secs"] = flush_secs
+                self.stats["max_flush_secs"] = max(self.stats["max_flush_secs"], flush_secs)
+                self.stats["total_flush_secs"] += flush_secs
+        if verbose:
+            print("done.")
+
+
+class JsonlCacheBackend(CacheBackend):
+    """
+    In-memory dict of openai responses backed by an append-only jsonl log (cache_path).
+    Every flush appends (and fsyncs) only the new records, so a save costs O(new entries).
+    When the log holds too many stale (overwritten) records, it is compacted by the
+    flusher thread.
+
+    With lazy=True only an index (hash of key -> offset in the log) is built at startup
+    and values are read from disk on demand; entries set in this process are kept in
+    memory until they are flushed.
+
+    With hashed_keys=True entries are keyed by OpenAICacheKey.digest() instead of the
+    full key, so prompts are neither kept in memory nor (unless keep_prompts) written
+    to disk. Legacy files load as they are; see migrate_cache to rewrite them.
+    """
+
+    def __init__(self, cache_path: str, save_every_n_seconds = 600,
+                 save_every_n_entries: int = 100,
+                 compact_min_stale_entries: int = 10000,
+                 compact_stale_ratio: float = 0.5,
+                 lazy: bool = False,
+                 hashed_keys: bool = False,
+                 keep_prompts: bool = False):
+        super().__init__(save_every_n_seconds=save_every_n_seconds, save_every_n_entries=save_every_n_entries)
+        self.compact_min_stale_entries = compact_min_stale_entries
+        self.compact_stale_ratio = compact_stale_ratio
+        self.lazy = lazy
+        self.hashed_keys = hashed_keys
+        self.keep_prompts = keep_prompts
+        # keyed by OpenAICacheKey, or by its digest with hashed_keys.
+        self.cache: Dict[Union[OpenAICacheKey, bytes], OpenAICacheValue] = {}
+        # lazy mode: hash(key) -> offset of the latest record of that key in the log.
+        # On a hash collision the older key is shadowed and simply misses.
+        self._offsets: Dict[int, int] = {}
         assert cache_path is not None, f"\n\ncaching openai: cache file is empty."
         self.cache_path: str = cache_path.strip()
+        # number of records in the log file (>= num_entries when keys were overwritten).
+        self.num_log_records = 0
+        # guards the handle used by lazy reads where there is no os.pread.
+        self._read_lock = threading.Lock()
+
         print(f"\nCaching: Loading cache from {self.cache_path}", end=" ... ")
-        cache_content_list = self.load_cache(self.cache_path)
-        # json.loads() is used twice to convert from serialized dict in str format to dict
-        if cache_content_list:
-            for x in cache_content_list:
-                j = json.loads(x)
-                k = OpenAICacheKey.from_json(j)
-                k.prompt = k.prompt.lstrip()  # strip leading whitespaces.
-                v = OpenAICacheValue.from_json(j)
-                self.cache[k] = v
+        for offset, j in read_records(self.cache_path):
+            k = self.key_of_record(j)
+            if lazy:
+                self._offsets[hash(k)] = offset
+            else:
+                self.cache[k] = OpenAICacheValue.from_json(j)
+            self.num_log_records += 1
+        self._log = self._open_log()
+        # lazy reads use (reader, offsets) as one snapshot; compaction swaps in a new pair, while
+        # readers of the old one keep reading the replaced file.
+        self._log_view = (open(self.cache_path, 'rb') if lazy else None, self._offsets)
+        self.start()
         print(f"[done]")
 
-    def cleanup(self):
-        # works similar to a destructor but does not offload builtins.open method.
-        print(f"\nFinal cleanup cache saving...", end="...")
-        self.save_cache()
+    def load_cache(self, fp) -> Iterator[Dict]:
+        for _, j in read_records(fp):
+            yield j
 
-    def load_cache(self, fp) -> List:
-        if not os.path.exists(fp) or os.path.getsize(fp) == 0:
-            write_txt(outpath=fp, data_str="")
-            return []
+    def iter_keys(self) -> Iterator[OpenAICacheKey]:
+        for _, j in read_records(self.cache_path):
+            if "prompt" in j:
+                yield record_to_entry(j)[0]
+
+    def _open_log(self):
+        log = open(self.cache_path, 'ab')
+        # do not glue new records onto a torn last line.
+        if log.tell() > 0:
+            with open(self.cache_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    log.write(b"\n")
+        return log
+
+    @property
+    def in_memory(self) -> bool:
+        return not self.lazy
+
+    @property
+    def stores_prompts(self) -> bool:
+        return self.keep_prompts or not self.hashed_keys
+
+    def key_of(self, key: OpenAICacheKey) -> Union[OpenAICacheKey, bytes]:
+        """The key used in self.cache for this cache key."""
+        return key.digest() if self.hashed_keys else key
+
+    def key_of_record(self, j: Dict) -> Union[OpenAICacheKey, bytes]:
+        return record_digest(j) if self.hashed_keys else record_to_entry(j)[0]
+
+    @property
+    def num_entries(self) -> int:
+        return len(self._offsets) + len(self.cache) if self.lazy else len(self.cache)
+
+    def get(self, key: OpenAICacheKey) -> Optional[OpenAICacheValue]:
+        k = self.key_of(key)
+        value = self.cache.get(k, None)
+        if value is None and self.lazy:
+            value = self._read_from_log(k)
+        return value
+
+    def _read_from_log(self, k) -> Optional[OpenAICacheValue]:
+        reader, offsets = self._log_view
+        offset = offsets.get(hash(k))
+        if offset is None:
+            return None
+        if hasattr(os, "pread"):
+            line = read_line_at(reader, offset)
         else:
-            return read_jsonl_or_json(fp)
+            with self._read_lock:
+                reader.seek(offset)
+                line = reader.readline()
+        j = decode_record(line)
+        return OpenAICacheValue.from_json(j) if self.key_of_record(j) == k else None
+
+    def remember(self, key: OpenAICacheKey, value: OpenAICacheValue):
+        self.cache[self.key_of(key)] = value
+
+    def write_batch(self, entries: List[Tuple[OpenAICacheKey, OpenAICacheValue]]) -> int:
+        if self._log.closed:
+            return 0
+        records = [encode_record(key, v, hashed_keys=self.hashed_keys, keep_prompts=self.keep_prompts)
+                   for key, v in entries]
+        offset = self._log.tell()
+        self._log.write(b"".join(records))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        with self._lock:
+            if self.lazy:
+                # flushed entries can now be served from disk.
+                for (key, v), record in zip(entries, records):
+                    k = self.key_of(key)
+                    self._offsets[hash(k)] = offset
+                    offset += len(record)
+                    if self.cache.get(k) is v:
+                        del self.cache[k]
+            self.num_log_records += len(entries)
+        return sum(len(r) for r in records)
+
+    def after_flush(self):
+        if self.needs_compaction():
+            self.compact()
+
+    def needs_compaction(self) -> bool:
+        num_entries = self.num_entries
+        num_stale = self.num_log_records - num_entries
+        return num_stale >= self.compact_min_stale_entries and \
+               num_stale >= self.compact_stale_ratio * num_entries
+
+    def compact(self):
+        """Rewrites the log with one record per key (dropping overwritten records).
+        Streams the log, keeping only the latest record of every key. Flushes wait
+        until the swap; get/set do not (unflushed entries stay in memory meanwhile)."""
+        tmp_path = f"{self.cache_path}.compact"
+        with self._io_lock:
+            if self.lazy:
+                with self._lock:
+                    offsets = dict(self._offsets)
+            else:
+                offsets = latest_offsets(self.cache_path, lambda j: hash(self.key_of_record(j)))
+            new_offsets = {}
+            with open(tmp_path, 'wb') as out, open(self.cache_path, 'rb') as f:
+                for offset, j in read_records(self.cache_path):
+                    h = hash(self.key_of_record(j))
+                    if offsets.get(h) == offset:
+                        new_offsets[h] = out.tell()
+                        f.seek(offset)
+                        out.write(f.readline())
+                out.flush()
+                os.fsync(out.fileno())
+            self._log.close()
+            os.replace(tmp_path, self.cache_path)
+            self._log = self._open_log()
+            with self._lock:
+                if self.lazy:
+                    self._offsets = new_offsets
+                    # the old reader is closed once no lazy read uses it anymore.
+                    with self._read_lock:
+                        self._log_view = (open(self.cache_path, 'rb'), new_offsets)
+                self.num_log_records = len(new_offsets)
+
 
-    def get(self, key: OpenAICacheKey) -> OpenAICacheValue:
+# the smallest share of max_memory_entries worth a stripe of its own.
+MIN_STRIPE_ENTRIES = 8
+
+
+class MemoryStripe:
+    """One independently locked slice of the LRU memory tier of Caching."""
+
+    def __init__(self, max_entries: Optional[int], max_bytes: Optional[float]):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (value, approx. size in bytes), least recently used first.
+        self.entries: "OrderedDict[OpenAICacheKey, Tuple[OpenAICacheValue, int]]" = OrderedDict()
+        self.num_bytes = 0
+        self.stats = {"hits": 0, "backend_hits": 0, "misses": 0, "evictions": 0}
+        self.lock = threading.Lock()
+
+    def remember(self, key: OpenAICacheKey, value: OpenAICacheValue):
+        """Puts an entry in the stripe and evicts the LRU entries over budget. Called under self.lock."""
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.num_bytes -= old[1]
+        # a DigestKey (near-duplicate match without the prompt) has no prompt to count.
+        size = len(key.prompt or "") + sum(len(r) for r in value.all_responses)
+        self.entries[key] = (value, size)
+        self.num_bytes += size
+        while len(self.entries) > 1 and (
+                (self.max_entries is not None and len(self.entries) > self.max_entries) or
+                (self.max_bytes is not None and self.num_bytes > self.max_bytes)):
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.num_bytes -= evicted_size
+            self.stats["evictions"] += 1
+
+
+class Caching:
+    """
+    Cache of openai responses; get/set are served by a CacheBackend (by default the
+    JsonlCacheBackend over cache_path, see sqlite_cache.SqliteCacheBackend for a
+    store shared by several processes).
+
+    With max_memory_entries and/or max_memory_bytes a bounded LRU tier of hot entries
+    sits in front of the backend, which must not hold everything in memory itself: the default
+    jsonl backend is then lazy, and a backend whose entries all live in memory (non-lazy jsonl,
+    packed) is rejected with a ValueError. The tier is split in memory_stripes
+    independently locked LRU stripes (by key hash, each with its share of the budget, which
+    add up to the budget; fewer for a small max_memory_entries) so concurrent gets rarely wait on each other. The LRU order is per
+    stripe: a stripe whose keys are hot evicts its own least recently used entry even when
+    another stripe holds older ones. get_memory_stats reports hits, misses and evictions of that tier.
+
+    Caching is safe to share between threads: backend gets do not lock, sets only queue the
+    entry, and saves swap the queue out and write it without holding the lock readers or
+    writers need (see CacheBackend).
+
+    With near_duplicate_threshold, a temperature 0 key that misses is served the value of a cached
+    near-duplicate prompt (see near_duplicates.NearDuplicateIndex, persisted at near_duplicate_index_path,
+    by default next to cache_path, and built from the cached entries the first time);
+    get_near_duplicate_stats reports the matches. The index stores prompts only if the backend
+    does (see CacheBackend.stores_prompts).
+    """
+
+    def __init__(self, cache_path: str = None, save_every_n_seconds = 600,
+                 save_every_n_entries: int = 100,
+                 compact_min_stale_entries: int = 10000,
+                 compact_stale_ratio: float = 0.5,
+                 lazy: bool = False,
+                 hashed_keys: bool = False,
+                 keep_prompts: bool = False,
+                 backend: CacheBackend = None,
+                 max_memory_entries: int = None,
+                 max_memory_bytes: int = None,
+                 memory_stripes: int = 16,
+                 near_duplicate_threshold: float = None,
+                 near_duplicate_index_path: str = None):
+        has_memory_tier = max_memory_entries is not None or max_memory_bytes is not None
+        if backend is not None and has_memory_tier and backend.in_memory:
+            raise ValueError(f"caching: max_memory_entries/max_memory_bytes would bound nothing, {type(backend).__name__} "
+                             f"holds every entry in memory (use a lazy jsonl or the sqlite backend).")
+        if backend is None:
+            backend = JsonlCacheBackend(cache_path=cache_path,
+                                        save_every_n_seconds=save_every_n_seconds,
+                                        save_every_n_entries=save_every_n_entries,
+                                        compact_min_stale_entries=compact_min_stale_entries,
+                                        compact_stale_ratio=compact_stale_ratio,
+                                        lazy=lazy or has_memory_tier, hashed_keys=hashed_keys, keep_prompts=keep_prompts)
+        self.backend = backend
+        self.max_memory_entries = max_memory_entries
+        self.max_memory_bytes = max_memory_bytes
+        self.has_memory_tier = has_memory_tier
+        # fewer stripes for a small cap, so that a stripe holds at least MIN_STRIPE_ENTRIES (a stripe of
+        # a single entry evicts it on every miss); the first max_memory_entries % num_stripes
+        # stripes hold one more, so the shares add up to the cap.
+        num_stripes = memory_stripes
+        if max_memory_entries is not None:
+            num_stripes = min(num_stripes, max_memory_entries // MIN_STRIPE_ENTRIES)
+        num_stripes = max(1, num_stripes)
+        self._stripes = [MemoryStripe(max_entries=max_memory_entries // num_stripes + (i < max_memory_entries % num_stripes)
+                                      if max_memory_entries is not None else None,
+                                      max_bytes=max_memory_bytes / num_stripes if max_memory_bytes is not None else None)
+                         for i in range(num_stripes)]
+        self.near_duplicates = None
+        if near_duplicate_threshold is not None:
+            from gptinference.near_duplicates import NearDuplicateIndex
+            cache_path = cache_path or getattr(backend, "cache_path", None) or getattr(backend, "db_path", None)
+            index_path = near_duplicate_index_path or f"{cache_path}.near_duplicates.jsonl"
+            is_new_index = not os.path.exists(index_path)
+            self.near_duplicates = NearDuplicateIndex(index_path=index_path, threshold=near_duplicate_threshold,
+                                                      keep_prompts=backend.stores_prompts)
+            if is_new_index:
+                # the entries cached before the index was enabled.
+                self.near_duplicates.backfill(backend.iter_keys())
+
+    def cleanup(self):
+        if self.near_duplicates is not None:
+            self.near_duplicates.save()
+        self.backend.cleanup()
+
+    @property
+    def num_entries(self) -> int:
+        return self.backend.num_entries
+
+    @property
+    def stats(self) -> Dict:
+        return self.backend.stats
+
+    def _stripe(self, key: OpenAICacheKey) -> MemoryStripe:
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def get_memory_stats(self) -> Dict:
+        stats = {"hits": 0, "backend_hits": 0, "misses": 0, "evictions": 0, "entries": 0, "bytes": 0}
+        for stripe in self._stripes:
+            with stripe.lock:
+                for name, n in stripe.stats.items():
+                    stats[name] += n
+                stats["entries"] += len(stripe.entries)
+                stats["bytes"] += stripe.num_bytes
+        return stats
+
+    def get_near_duplicate_stats(self) -> Dict:
+        return self.near_duplicates.get_stats() if self.near_duplicates is not None else {}
+
+    @property
+    def gets_from_memory(self) -> bool:
+        """Whether get and set are cheap enough to run on an event loop: no disk reads and no
+        near-duplicate signatures to compute."""
+        return self.near_duplicates is None and self.backend.in_memory
+
+    def get(self, key: OpenAICacheKey, near_duplicates: bool = True) -> OpenAICacheValue:
+        """near_duplicates=False skips the near-duplicate lookup (for a key that just missed it)."""
         assert key is not None and key, f"caching: cache key is empty ({key})."
-        return self.cache.get(key, None)
+        value = self._get_exact(key)
+        if value is None and near_duplicates and self.near_duplicates is not None:
+            match = self.near_duplicates.lookup(key)
+            if match is not None:
+                value = self._get_exact(match[0])
+        return value
+
+    def _get_exact(self, key: OpenAICacheKey) -> OpenAICacheValue:
+        if not self.has_memory_tier:
+            return self.backend.get(key)
+        stripe = self._stripe(key)
+        with stripe.lock:
+            entry = stripe.entries.get(key)
+            if entry is not None:
+                stripe.entries.move_to_end(key)
+                stripe.stats["hits"] += 1
+                return entry[0]
+        value = self.backend.get(key)
+        with stripe.lock:
+            if value is None:
+                stripe.stats["misses"] += 1
+            else:
+                stripe.stats["backend_hits"] += 1
+                stripe.remember(key, value)
+        return value
 
     def set(self, key, value, verbose=False) -> OpenAICacheValue:
-        secs_since_last_save = time.time() - self.cache_started_at
-        if secs_since_last_save % self.save_every_n_seconds == 0:
-            if verbose:
-                print(f"\nPeriodic cache saving... with {len(self.cache.items())} pts ... ", end=" ... ")
-            self.save_cache()
         assert key is not None and key, f"caching: cache key is wrong ({key})."
         assert value is not None and len(f"{value}")>0, f"caching: value to cache is empty ({value})."
-        # print(f"\nCache addition happening: before {len(self.cache.items())} pts ", end=" ... ")
-        self.cache[key] = value
-        # print(f" after {len(self.cache.items())} pts ")
-        return value
+        if self.has_memory_tier:
+            stripe = self._stripe(key)
+            with stripe.lock:
+                stripe.remember(key, value)
+        if self.near_duplicates is not None:
+            self.near_duplicates.add(key)
+        return self.backend.set(key, value, verbose=verbose)
 
     def save_cache(self, verbose=False):
-        if verbose:
-            print(f"\nCaching: Saving openai cache [{self.cache_path}] with {len(self.cache.items())} pts in ", end=" ... ")
-        data_points = []
-        for x, y in self.cache.items():
-            key_with_value = x.to_json()
-            key_with_value["first_response"] = y.first_response
-            data_points.append(json.dumps(key_with_value))
-        if verbose:
-            print(f" {len(data_points)} lines", end=" .")
-        write_jsonl(data_points=data_points, outpath=self.cache_path, append=False)
-        if verbose:
-            print("done.")
+        if self.near_duplicates is not None:
+            self.near_duplicates.save()
+        self.backend.save_cache(verbose=verbose)
@@ -0,0 +1,149 @@
+"""
+Checkpointed, resumable runs of a task over a large jsonl dataset on several processes
+(and machines).
+
+The input file is split into num_shards byte ranges (aligned to lines). Shard i writes
+    <output_dir>/cache.shard<i>.jsonl        its own cache (no two processes share a cache file)
+    <output_dir>/output.shard<i>.jsonl       {"offset": .., "input": .., "output": ..} in input order
+    <output_dir>/checkpoint.shard<i>.json    the input offset to resume from
+so a killed run started again with the same arguments continues where every shard stopped.
+merge_dataset_run concatenates the output shards (in input order) and merges the cache shards
+into one deduplicated cache.
+
+    def make_task(openai_wrapper):  # must be picklable, i.e. a module level function
+        return AbstractTakeawayForClaimTask(engine="gpt-4o", openai_wrapper=openai_wrapper)
+
+    run_dataset("claims.jsonl", "run/", make_task, num_shards=8)
+    merge_dataset_run("run/", num_shards=8)
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+from gptinference.caching import merge_caches
+from gptinference.openai_wrapper import OpenAIWrapper
+from gptinference.pipeline import map_stream
+
+
+def shard_path(output_dir: str, name: str, shard_id: int, ext: str = "jsonl") -> str:
+    return os.path.join(output_dir, f"{name}.shard{shard_id}.{ext}")
+
+
+def shard_range(input_path: str, shard_id: int, num_shards: int) -> Tuple[int, int]:
+    """Byte range [start, end) of the input file; shard i gets the lines that start in its range."""
+    size = os.path.getsize(input_path)
+    return size * shard_id // num_shards, size * (shard_id + 1) // num_shards
+
+
+def read_shard(input_path: str, start: int, end: int) -> Iterator[Tuple[int, int, Dict]]:
+    """Streams (offset, next offset, record) of the lines that start in [start, end)."""
+    with open(input_path, 'rb') as f:
+        if start > 0:
+            # skip to the first line starting at or after start.
+            f.seek(start - 1)
+            f.readline()
+        while True:
+            offset = f.tell()
+            if offset >= end:
+                return
+            line = f.readline()
+            if not line:
+                return
+            if line.strip():
+                yield offset, f.tell(), json.loads(line)
+
+
+def read_checkpoint(path: str) -> Dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_checkpoint(path: str, checkpoint: Dict):
+    # write + rename, so a crash leaves either the old or the new checkpoint.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def run_shard(input_path: str, output_dir: str, make_task: Callable, shard_id: int, num_shards: int,
+              window: int = 8, checkpoint_every_n: int = 100, wrapper_kwargs: Dict = None) -> Dict:
+    """Runs the task over one shard of input_path, resuming from its checkpoint. Returns the final checkpoint."""
+    start, end = shard_range(input_path, shard_id=shard_id, num_shards=num_shards)
+    checkpoint_path = shard_path(output_dir, "checkpoint", shard_id, ext="json")
+    output_path = shard_path(output_dir, "output", shard_id)
+    checkpoint = read_checkpoint(checkpoint_path) or {"next_offset": start, "output_size": 0, "num_done": 0, "done": False}
+    if checkpoint["done"]:
+        return checkpoint
+
+    openai_wrapper = OpenAIWrapper(cache_path=shard_path(output_dir, "cache", shard_id), **(wrapper_kwargs or {}))
+    task = make_task(openai_wrapper)
+
+    def run_one(item):
+        offset, next_offset, record = item
+        return offset, next_offset, record, task(**record) if isinstance(record, dict) else task(record)
+
+    with open(output_path, 'ab') as out:
+        # drop outputs written after the last checkpoint, they are recomputed (from the cache).
+        out.truncate(checkpoint["output_size"])
+        out.seek(checkpoint["output_size"])
+        num_since_checkpoint = 0
+        for offset, next_offset, record, output in map_stream(run_one, read_shard(input_path, checkpoint["next_offset"], end),
+                                                              window=window, openai_wrapper=openai_wrapper):
+            out.write((json.dumps({"offset": offset, "input": record, "output": output}) + "\n").encode("utf-8"))
+            checkpoint["next_offset"] = next_offset
+            checkpoint["num_done"] += 1
+            num_since_checkpoint += 1
+            if num_since_checkpoint >= checkpoint_every_n:
+                # the cache goes first: a resumed run then finds the outputs after the checkpoint cached.
+                openai_wrapper.cache.save_cache()
+                out.flush()
+                os.fsync(out.fileno())
+                checkpoint["output_size"] = out.tell()
+                write_checkpoint(checkpoint_path, checkpoint)
+                num_since_checkpoint = 0
+        openai_wrapper.cache.save_cache()
+        out.flush()
+        os.fsync(out.fileno())
+        checkpoint["output_size"] = out.tell()
+    checkpoint["done"] = True
+    write_checkpoint(checkpoint_path, checkpoint)
+    return checkpoint
+
+
+def run_dataset(input_path: str, output_dir: str, make_task: Callable, num_shards: int = 4,
+                shard_ids: Iterable[int] = None, num_workers: int = None, window: int = 8,
+                checkpoint_every_n: int = 100, wrapper_kwargs: Dict = None) -> List[Dict]:
+    """Runs shard_ids (default: all num_shards; pass a subset to spread a run over machines)
+    on a pool of num_workers processes. Returns the checkpoint of every shard."""
+    os.makedirs(output_dir, exist_ok=True)
+    shard_ids = list(range(num_shards)) if shard_ids is None else list(shard_ids)
+    with ProcessPoolExecutor(max_workers=num_workers or len(shard_ids)) as pool:
+        futures = [pool.submit(run_shard, input_path, output_dir, make_task, shard_id, num_shards,
+                               window, checkpoint_every_n, wrapper_kwargs)
+                   for shard_id in shard_ids]
+        return [future.result() for future in futures]
+
+
+def merge_dataset_run(output_dir: str, num_shards: int, output_path: str = None, cache_path: str = None) -> int:
+    """Concatenates the output shards into output_path (in input order) and merges the cache
+    shards into cache_path, one record per key. Returns the number of cached entries."""
+    output_path = output_path or os.path.join(output_dir, "output.jsonl")
+    cache_path = cache_path or os.path.join(output_dir, "cache.jsonl")
+    with open(output_path, 'wb') as out:
+        for shard_id in range(num_shards):
+            checkpoint = read_checkpoint(shard_path(output_dir, "checkpoint", shard_id, ext="json"))
+            assert checkpoint.get("done"), f"shard {shard_id} has not finished, run it again to resume it."
+            with open(shard_path(output_dir, "output", shard_id), 'rb') as f:
+                # copy in chunks, outputs can be large.
+                while True:
+                    chunk = f.read(1 << 20)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+    return merge_caches([shard_path(output_dir, "cache", shard_id) for shard_id in range(num_shards)], cache_path)
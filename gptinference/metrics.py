@@ -0,0 +1,202 @@
+import bisect
+import json
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+# engine -> dollars per 1M input / output tokens, see https://openai.com/api/pricing/
+# (extend or override with load_pricing / set_price).
+pricing: Dict[str, Dict[str, float]] = {
+    "gpt-3.5-turbo": {"input": 0.5, "output": 1.5},
+    "gpt-4": {"input": 30.0, "output": 60.0},
+    "gpt-4-turbo": {"input": 10.0, "output": 30.0},
+    "gpt-4o": {"input": 5.0, "output": 15.0},
+}
+
+
+def set_price(engine: str, input_per_million: float, output_per_million: float):
+    pricing[engine] = {"input": input_per_million, "output": output_per_million}
+
+
+def load_pricing(path: str):
+    """Loads a json file {engine: {"input": <dollars per 1M tokens>, "output": ..}, ..} into the pricing table."""
+    with open(path, 'r') as f:
+        for engine, prices in json.load(f).items():
+            set_price(engine, input_per_million=prices["input"], output_per_million=prices["output"])
+
+
+def price_of(engine: str) -> Optional[Dict[str, float]]:
+    return pricing.get(engine)
+
+
+def cost_of(engine: str, input_tokens: int, output_tokens: int) -> float:
+    """Dollar cost of the tokens, 0 if the engine has no price."""
+    price = price_of(engine)
+    return (input_tokens * price["input"] + output_tokens * price["output"]) / 1e6 if price else 0.0
+
+
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # counts[i] observations <= buckets[i] (and > buckets[i-1]); the last one is +Inf.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> List[Tuple[str, int]]:
+        """[(le, number of observations <= le), ..] ending with ("+Inf", count), as prometheus expects."""
+        result, total = [], 0
+        for le, n in zip([str(b) for b in self.buckets] + ["+Inf"], self.counts):
+            total += n
+            result.append((le, total))
+        return result
+
+    def to_json(self) -> Dict:
+        return {"count": self.count, "sum": self.sum, "buckets": dict(self.cumulative_counts())}
+
+
+COUNTERS = ("requests", "cache_hits", "cache_misses", "api_calls", "api_errors", "retries",
+            "input_tokens", "output_tokens", "dollar_cost", "unpriced_responses",
+            # what the cache hits avoided, from the usage and latency cached with the entries.
+            "saved_input_tokens", "saved_output_tokens", "saved_dollar_cost", "saved_secs")
+HISTOGRAMS = ("api_latency_secs", "cache_lookup_secs", "retry_sleep_secs")
+HOOKS = ("before_request", "after_response", "on_cache_hit")
+
+
+def label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Per engine counters (requests, cache hits/misses, api calls and errors, retries, tokens, dollars,
+    and the tokens, dollars and seconds the cache hits saved)
+    and latency histograms (api time, cache lookup time, retry sleeps) of OpenAIWrapper calls.
+
+    Hooks are called with keyword arguments:
+      before_request(engine, prompt), after_response(engine, response, latency_secs, dollar_cost),
+      on_cache_hit(engine, key).
+    A failing hook is reported and ignored, it never fails the call.
+    """
+
+    def __init__(self, latency_buckets: Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS):
+        self.latency_buckets = latency_buckets
+        self._counters: Dict[str, Dict[str, float]] = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+        self._histograms: Dict[str, Dict[str, Histogram]] = defaultdict(
+            lambda: {name: Histogram(self.latency_buckets) for name in HISTOGRAMS})
+        self.hooks: Dict[str, List[Callable]] = {event: [] for event in HOOKS}
+        self._lock = threading.Lock()
+
+    def add_hook(self, event: str, fn: Callable):
+        assert event in self.hooks, f"metrics: unknown hook {event}, expected one of {HOOKS}."
+        self.hooks[event].append(fn)
+
+    def remove_hook(self, event: str, fn: Callable):
+        self.hooks[event].remove(fn)
+
+    def _fire(self, event: str, **kwargs):
+        for fn in self.hooks[event]:
+            try:
+                fn(**kwargs)
+            except Exception as e:
+                print(f"Error in {event} hook {fn}: {e}")
+
+    def _add(self, engine: str, **counts):
+        with self._lock:
+            counters = self._counters[engine]
+            for name, n in counts.items():
+                counters[name] += n
+
+    def _observe(self, engine: str, histogram: str, value: float):
+        with self._lock:
+            self._histograms[engine][histogram].observe(value)
+
+    def record_cache_lookup(self, engine: str, secs: float, hit: bool, key=None, count_request: bool = True, value=None):
+        """value: the cached OpenAICacheValue of a hit, whose usage and latency count as saved."""
+        usage = (getattr(value, "usage", None) or {}) if hit else {}
+        input_tokens, output_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        with self._lock:
+            counters = self._counters[engine]
+            counters["requests"] += 1 if count_request else 0
+            counters["cache_hits" if hit else "cache_misses"] += 1
+            counters["saved_input_tokens"] += input_tokens
+            counters["saved_output_tokens"] += output_tokens
+            counters["saved_dollar_cost"] += cost_of(engine, input_tokens, output_tokens)
+            counters["saved_secs"] += (getattr(value, "latency_secs", None) or 0.0) if hit else 0.0
+            self._histograms[engine]["cache_lookup_secs"].observe(secs)
+        if hit:
+            self._fire("on_cache_hit", engine=engine, key=key)
+
+    def before_request(self, engine: str, prompt):
+        self._fire("before_request", engine=engine, prompt=prompt)
+
+    def record_response(self, engine: str, response, latency_secs: float) -> float:
+        """Counts an api response (its tokens and cost, 0 if the engine has no price); returns the cost."""
+        usage = getattr(response, "usage", None)
+        input_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        output_tokens = getattr(usage, "completion_tokens", 0) or 0
+        dollar_cost = cost_of(engine, input_tokens, output_tokens)
+        self._add(engine, api_calls=1, input_tokens=input_tokens, output_tokens=output_tokens,
+                  dollar_cost=dollar_cost, unpriced_responses=0 if price_of(engine) else 1)
+        self._observe(engine, "api_latency_secs", latency_secs)
+        self._fire("after_response", engine=engine, response=response, latency_secs=latency_secs, dollar_cost=dollar_cost)
+        return dollar_cost
+
+    def record_api_error(self, engine: str, latency_secs: float):
+        self._add(engine, api_errors=1)
+        self._observe(engine, "api_latency_secs", latency_secs)
+
+    def record_retry_sleep(self, engine: str, secs: float):
+        self._add(engine, retries=1)
+        self._observe(engine, "retry_sleep_secs", secs)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> Dict:
+        """{engine: {<counter>: .., "cache_hit_ratio": .., <histogram>: {"count", "sum", "buckets"}}}"""
+        with self._lock:
+            result = {}
+            for engine in sorted(set(self._counters) | set(self._histograms)):
+                counters = dict(self._counters[engine])
+                num_lookups = counters["cache_hits"] + counters["cache_misses"]
+                counters["cache_hit_ratio"] = counters["cache_hits"] / num_lookups if num_lookups else 0.0
+                for name, histogram in self._histograms[engine].items():
+                    counters[name] = histogram.to_json()
+                result[engine] = counters
+            return result
+
+    def to_prometheus(self, prefix: str = "gptinference") -> str:
+        """The metrics in the prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name in COUNTERS:
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for engine, m in snapshot.items():
+                lines.append(f'{prefix}_{name}_total{{engine="{label(engine)}"}} {m[name]}')
+        lines.append(f"# TYPE {prefix}_cache_hit_ratio gauge")
+        for engine, m in snapshot.items():
+            lines.append(f'{prefix}_cache_hit_ratio{{engine="{label(engine)}"}} {m["cache_hit_ratio"]}')
+        for name in HISTOGRAMS:
+            metric = f"{prefix}_{name.replace('_secs', '_seconds')}"
+            lines.append(f"# TYPE {metric} histogram")
+            for engine, m in snapshot.items():
+                for le, n in m[name]["buckets"].items():
+                    lines.append(f'{metric}_bucket{{engine="{label(engine)}",le="{le}"}} {n}')
+                lines.append(f'{metric}_sum{{engine="{label(engine)}"}} {m[name]["sum"]}')
+                lines.append(f'{metric}_count{{engine="{label(engine)}"}} {m[name]["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+# shared by the wrappers that are not given their own Metrics.
+metrics = Metrics()
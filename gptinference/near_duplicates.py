@@ -0,0 +1,200 @@
+import atexit
+import base64
+import hashlib
+import json
+import os
+import threading
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from gptinference.caching import DigestKey, OpenAICacheKey
+
+EMPTY_BIN = 0xFFFFFFFF
+
+
+def normalize_prompt(prompt: str, separators: Tuple[str, ...] = ("###",)) -> str:
+    """Collapses whitespace runs (so intra/inter example separators made of new lines do not matter)
+    and drops trailing separators."""
+    prompt = " ".join(str(prompt).split())
+    stripped = True
+    while stripped and prompt:
+        stripped = False
+        for sep in separators:
+            if sep and prompt.endswith(sep):
+                prompt = prompt[:-len(sep)].rstrip()
+                stripped = True
+    return prompt
+
+
+def minhash_signature(text: str, num_perm: int = 128, shingle_size: int = 5) -> array:
+    """MinHash of the character shingles of text, with one-permutation hashing: every shingle is
+    hashed once, the hash picks one of num_perm bins and each bin keeps its minimum."""
+    signature = array('I', [EMPTY_BIN]) * num_perm
+    data = text.encode("utf-8")
+    for i in range(max(1, len(data) - shingle_size + 1)):
+        h = int.from_bytes(hashlib.blake2b(data[i:i + shingle_size], digest_size=8).digest(), "little")
+        b, v = h % num_perm, h >> 32
+        if v < signature[b]:
+            signature[b] = v
+    return signature
+
+
+def estimated_jaccard(a: array, b: array) -> float:
+    num_bins = sum(1 for x, y in zip(a, b) if x != EMPTY_BIN or y != EMPTY_BIN)
+    if num_bins == 0:
+        return 1.0
+    return sum(1 for x, y in zip(a, b) if x == y and x != EMPTY_BIN) / num_bins
+
+
+def lsh_params(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """(bands, rows per band) whose s-curve rises closest to threshold, i.e. (1/bands)^(1/rows) ~ threshold."""
+    candidates = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    return min(candidates, key=lambda br: abs((1 / br[0]) ** (1 / br[1]) - threshold))
+
+
+class NearDuplicateIndex:
+    """
+    MinHash-LSH index over the prompts of cached temperature 0 keys, to serve a prompt that is a
+    near-duplicate (estimated Jaccard similarity of its character shingles >= threshold, after
+    normalize_prompt) of a cached one. Only keys with the same engine, stop token and max tokens match.
+
+    The index is an append-only jsonl file at index_path ({"key": .., "sig": ..} per line, the key
+    includes the prompt); see backfill to index the prompts cached before it was enabled.
+    With keep_prompts=False (caches that do not store prompts) neither the file nor memory holds
+    prompts: a line is {"digest": .., "engine": .., "stop_token": .., "temperature": ..,
+    "max_tokens": .., "sig": ..} and lookup returns a DigestKey.
+    """
+
+    def __init__(self, index_path: str, threshold: float = 0.9, num_perm: int = 128, shingle_size: int = 5,
+                 separators: Tuple[str, ...] = ("###",), keep_prompts: bool = True):
+        assert 0 < threshold <= 1, f"near duplicates: threshold must be in (0, 1] ({threshold})."
+        self.index_path = index_path
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.separators = separators
+        self.keep_prompts = keep_prompts
+        self.num_bands, self.band_rows = lsh_params(threshold, num_perm)
+        # OpenAICacheKey, or DigestKey without keep_prompts.
+        self.keys: List[Union[OpenAICacheKey, DigestKey]] = []
+        self.signatures: List[array] = []
+        # digests of the indexed keys.
+        self._indexed = set()
+        # hash((engine, stop token, max tokens, band number, band)) -> ids of keys.
+        self._buckets: Dict[int, List[int]] = {}
+        self._unsaved: List[int] = []
+        self._lock = threading.Lock()
+        self.stats = {"lookups": 0, "matches": 0, "rejected_candidates": 0}
+        self._load()
+        atexit.register(self.save)
+
+    @staticmethod
+    def indexable(key: OpenAICacheKey) -> bool:
+        return float(key.temperature) == 0.0
+
+    def signature(self, key: OpenAICacheKey) -> array:
+        return minhash_signature(normalize_prompt(key.prompt, self.separators), num_perm=self.num_perm,
+                                 shingle_size=self.shingle_size)
+
+    def _band_hashes(self, key: Union[OpenAICacheKey, DigestKey], signature: array) -> List[int]:
+        rows = self.band_rows
+        return [hash((key.engine, key.stop_token, float(key.max_tokens), band, tuple(signature[band * rows:(band + 1) * rows])))
+                for band in range(self.num_bands)]
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r') as f:
+            for line in f:
+                try:
+                    j = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a torn last line.
+                signature = array('I')
+                signature.frombytes(base64.b64decode(j["sig"]))
+                if len(signature) != self.num_perm:
+                    continue
+                if "key" in j:
+                    key = OpenAICacheKey.from_json(j["key"])
+                else:
+                    key = DigestKey(bytes.fromhex(j["digest"]), engine=j["engine"], stop_token=j["stop_token"],
+                                    temperature=float(j["temperature"]), max_tokens=float(j["max_tokens"]))
+                self._add(key, signature)
+        self._unsaved = []
+
+    def _add(self, key: Union[OpenAICacheKey, DigestKey], signature: array):
+        """Called under _lock (or from _load)."""
+        digest = key.digest()
+        if digest in self._indexed:
+            return
+        self._indexed.add(digest)
+        if not self.keep_prompts and isinstance(key, OpenAICacheKey):
+            key = DigestKey.of(key)
+        key_id = len(self.keys)
+        self.keys.append(key)
+        self.signatures.append(signature)
+        for h in self._band_hashes(key, signature):
+            self._buckets.setdefault(h, []).append(key_id)
+        self._unsaved.append(key_id)
+
+    def add(self, key: OpenAICacheKey):
+        if not self.indexable(key):
+            return
+        with self._lock:
+            if key.digest() in self._indexed:
+                return
+        signature = self.signature(key)
+        with self._lock:
+            self._add(key, signature)
+
+    def backfill(self, keys: Iterable[OpenAICacheKey]) -> int:
+        """Indexes keys that are already cached (e.g. CacheBackend.iter_keys) and saves; returns how many."""
+        print(f"\nCaching: Building the near-duplicate index {self.index_path}", end=" ... ")
+        num_keys = 0
+        for key in keys:
+            if self.indexable(key):
+                self.add(key)
+                num_keys += 1
+        self.save()
+        print(f"[done]")
+        return num_keys
+
+    def lookup(self, key: OpenAICacheKey) -> Optional[Tuple[Union[OpenAICacheKey, DigestKey], float]]:
+        """The most similar indexed key at or above threshold, with its estimated similarity (None if none)."""
+        if not self.indexable(key):
+            return None
+        signature = self.signature(key)
+        best, best_similarity = None, 0.0
+        with self._lock:
+            self.stats["lookups"] += 1
+            candidates = {key_id for h in self._band_hashes(key, signature) for key_id in self._buckets.get(h, [])}
+            for key_id in candidates:
+                similarity = estimated_jaccard(signature, self.signatures[key_id])
+                if similarity < self.threshold:
+                    self.stats["rejected_candidates"] += 1
+                elif similarity > best_similarity:
+                    best, best_similarity = self.keys[key_id], similarity
+            if best is not None:
+                self.stats["matches"] += 1
+        return (best, best_similarity) if best is not None else None
+
+    def save(self):
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, []
+            lines = [json.dumps(dict(self._key_json(self.keys[key_id]),
+                                     sig=base64.b64encode(self.signatures[key_id].tobytes()).decode("ascii"))) + "\n"
+                     for key_id in unsaved]
+        if lines:
+            with open(self.index_path, 'a') as f:
+                f.writelines(lines)
+
+    @staticmethod
+    def _key_json(key: Union[OpenAICacheKey, DigestKey]) -> Dict:
+        if isinstance(key, OpenAICacheKey):
+            return {"key": key.to_json()}
+        return {"digest": key.digest().hex(), "engine": key.engine, "stop_token": key.stop_token,
+                "temperature": key.temperature, "max_tokens": key.max_tokens}
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return dict(self.stats, entries=len(self.keys))
@@ -1,19 +1,123 @@
+import asyncio
 import os
-from typing import Dict, Any, List, Union
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 import openai
-import random
 import time
+import warnings
+
+from gptinference.retry_policy import RetryPolicy
+from gptinference.routing import router
 
 # Use the latest openai chat /v1/ endpoint.
 # openai.api_key = os.getenv("OPENAI_API_KEY")
-openai_client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY") or openai.api_key)
+# Clients are created lazily (see get_client), so importing this module needs no api key.
+
+
+class ProviderConfig:
+    """An OpenAI compatible endpoint and the HTTP connection pool of its clients."""
+
+    def __init__(self, base_url: str = None, api_key: str = None, api_key_env: str = "OPENAI_API_KEY",
+                 max_connections: int = 100, max_keepalive_connections: int = 20,
+                 keepalive_expiry_secs: float = 30, timeout_secs: float = 600, connect_timeout_secs: float = 5,
+                 client_max_retries: int = 2):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.api_key_env = api_key_env
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry_secs = keepalive_expiry_secs
+        self.timeout_secs = timeout_secs
+        self.connect_timeout_secs = connect_timeout_secs
+        # retries inside the openai clients given to other callers of get_client; the requests of
+        # OpenaiAPIWrapper are retried by their RetryPolicy only (see get_client's client_retries).
+        self.client_max_retries = client_max_retries
+
+    def make_client(self, is_async: bool):
+        import httpx
+        limits = httpx.Limits(max_connections=self.max_connections,
+                              max_keepalive_connections=self.max_keepalive_connections,
+                              keepalive_expiry=self.keepalive_expiry_secs)
+        timeout = httpx.Timeout(self.timeout_secs, connect=self.connect_timeout_secs)
+        api_key = self.api_key or os.getenv(self.api_key_env) or openai.api_key
+        if is_async:
+            return openai.AsyncOpenAI(api_key=api_key, base_url=self.base_url, timeout=timeout,
+                                      max_retries=self.client_max_retries, http_client=httpx.AsyncClient(limits=limits, timeout=timeout))
+        return openai.OpenAI(api_key=api_key, base_url=self.base_url, timeout=timeout,
+                             max_retries=self.client_max_retries, http_client=httpx.Client(limits=limits, timeout=timeout))
+
+
+# provider name -> its endpoint; engines use "openai" unless set_engine_provider says otherwise.
+providers: Dict[str, ProviderConfig] = {
+    "openai": ProviderConfig(),
+    "together": ProviderConfig(base_url="https://api.together.xyz/v1", api_key_env="TOGETHER_API_KEY"),
+}
+engine_providers: Dict[str, str] = {}
+# (provider name, is_async, client_retries) -> client, shared by every caller so that connections stay warm.
+_clients: Dict[Tuple[str, bool, bool], Any] = {}
+_clients_lock = threading.Lock()
+
+
+def register_provider(name: str, base_url: str = None, **config):
+    """Adds (or reconfigures) an OpenAI compatible provider; see ProviderConfig for the pool settings."""
+    with _clients_lock:
+        providers[name] = ProviderConfig(base_url=base_url, **config)
+        for is_async in (False, True):
+            for client_retries in (False, True):
+                _clients.pop((name, is_async, client_retries), None)
+
+
+def set_engine_provider(engine: str, provider: str):
+    assert provider in providers, f"Unknown provider {provider}, see register_provider."
+    engine_providers[engine] = provider
+
+
+def _forget_clients():
+    """In a forked child: the parent's pooled clients hold its keep-alive sockets, which the two
+    processes must not share (requests would interleave and read each other's responses)."""
+    global _clients_lock
+    _clients_lock = threading.Lock()
+    _clients.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_clients)
+
+
+def get_client(engine: str = None, provider: str = None, is_async: bool = False, client_retries: bool = True):
+    """The (lazily created) client of provider, or of the provider serving engine.
+    With client_retries=False the client does not retry on its own (max_retries=0, same connection
+    pool): under a RetryPolicy its retries would sleep and resend within one attempt, past the
+    attempt's timeout and unseen by the policy."""
+    provider = provider or engine_providers.get(engine, "openai")
+    key = (provider, is_async, client_retries)
+    client = _clients.get(key)
+    if client is None:
+        if not client_retries:
+            client = get_client(provider=provider, is_async=is_async).with_options(max_retries=0)
+        with _clients_lock:
+            if key not in _clients:
+                _clients[key] = client or providers[provider].make_client(is_async=is_async)
+            client = _clients[key]
+    return client
+
 
 # check if org is set (never needed it, so commenting out)
 # if os.getenv("OPENAI_ORG") is not None:
 #     openai.organization = os.getenv("OPENAI_ORG")
 MAX_TRIES= int(os.getenv("OPENAI_MAX_TRIES_INT")) if os.getenv("OPENAI_MAX_TRIES_INT") is not None else 10
+# used by OpenaiAPIWrapper when no retry_policy is given.
+default_retry_policy = RetryPolicy(max_retries=MAX_TRIES)
+
+
+def _deprecated_retry_policy(name: str, initial_delay: float, max_retries: int, errors) -> RetryPolicy:
+    warnings.warn(f"{name} is deprecated, use gptinference.retry_policy.RetryPolicy.", DeprecationWarning, stacklevel=3)
+    policy = RetryPolicy(max_retries=max_retries, initial_delay_secs=initial_delay)
+    # retries the given errors only, as before.
+    policy.is_retryable = lambda e: isinstance(e, errors)
+    return policy
+
 
-# from https://github.com/openai/openai-cookbook/blob/main/examples/How_to_handle_rate_limits.ipynb
 def retry_with_exponential_backoff(
     func,
     initial_delay: float = 1,
@@ -22,37 +126,29 @@ def retry_with_exponential_backoff(
     max_retries: int = MAX_TRIES,
     errors: tuple = (openai.RateLimitError),
 ):
-    """Retry a function with exponential backoff."""
+    """Deprecated, kept for callers importing it: retries func on errors under a RetryPolicy
+    (its decorrelated jitter replaces exponential_base and jitter, which are ignored)."""
+    policy = _deprecated_retry_policy("retry_with_exponential_backoff", initial_delay, max_retries, errors)
 
     def wrapper(*args, **kwargs):
-        # Initialize variables
-        num_retries = 0
-        delay = initial_delay
-
-        # Loop until a successful response or max_retries is hit or an exception is raised
-        while True:
-            try:
-
-                return func(*args, **kwargs)
+        return policy.call(lambda timeout_secs: func(*args, **kwargs), hedge=False)
 
-            # Retry on specified errors
-            except errors as e:
-                # Increment retries
-                num_retries += 1
-
-                # Check if max retries has been reached
-                if num_retries > max_retries:
-                    raise Exception(f"Maximum number of retries ({max_retries}) exceeded.")
+    return wrapper
 
-                # Increment the delay
-                delay *= exponential_base * (1 + jitter * random.random())
 
-                # Sleep for the delay
-                time.sleep(delay)
+def async_retry_with_exponential_backoff(
+    func,
+    initial_delay: float = 1,
+    exponential_base: float = 2,
+    jitter: bool = True,
+    max_retries: int = MAX_TRIES,
+    errors: tuple = (openai.RateLimitError),
+):
+    """Deprecated, same as retry_with_exponential_backoff for coroutines."""
+    policy = _deprecated_retry_policy("async_retry_with_exponential_backoff", initial_delay, max_retries, errors)
 
-            # Raise exceptions for any errors not specified
-            except Exception as e:
-                raise e
+    async def wrapper(*args, **kwargs):
+        return await policy.acall(lambda timeout_secs: func(*args, **kwargs), hedge=False)
 
     return wrapper
 
@@ -60,42 +156,216 @@ def retry_with_exponential_backoff(
 def is_chat_based_agent(engine):
     return not engine.lower().strip() == "gpt-3"
 
+
+def to_chat_messages(prompt: Union[str, List[str], List[Dict[str, str]]]) -> List[Dict[str, str]]:
+    # check if batched requests (list of text prompts) are requested.
+    batched_requested = isinstance(prompt, List) and len(prompt) > 1 and isinstance(prompt[0], str)
+    assert not batched_requested, \
+        f"Open AI does not support batched requests. Check your prompt in the call to OpenaiAPIWrapper."
+
+    if isinstance(prompt, List):
+        assert len(prompt) >= 1, f"No prompt given as input to call OpenAI API."
+
+    # check if prompt is a list of strings or a list of dictionaries
+    # gpt-3.5-turbo onwards does not support a batched list of prompts.
+    # but, the conversation API does support a list of dictionaries.
+    return [{"role": "user", "content": prompt[0]}] if isinstance(prompt, List) and isinstance(prompt[0], str) \
+                else ([{"role": "user", "content": prompt}] if isinstance(prompt, str) \
+                else prompt)
+
+def routed_create(engine: str, create):
+    """create(client, model) against the endpoints routed for engine (see routing.add_route),
+    fastest healthy first, failing over to the next on a retryable API error (see
+    RetryPolicy.is_retryable; other errors, e.g. a context too long, would fail everywhere and
+    are raised at once). Engines without a route use the client of their provider. Runs one
+    RetryPolicy attempt, so the clients do not retry on their own."""
+    endpoints = router.ranked(engine)
+    if not endpoints:
+        return create(get_client(engine, client_retries=False), engine)
+    last_error = None
+    for endpoint in endpoints:
+        started_at = time.time()
+        try:
+            response = create(get_client(provider=endpoint.provider, client_retries=False), endpoint.model)
+        except openai.APIError as e:
+            if not RetryPolicy.is_retryable(e):
+                raise
+            router.record(endpoint, time.time() - started_at, error=True)
+            last_error = e
+            continue
+        router.record(endpoint, time.time() - started_at, error=False)
+        return response
+    # every endpoint failed; a rate limit error is then retried with backoff by the caller.
+    raise last_error
+
+
+async def async_routed_create(engine: str, create):
+    """Awaitable version of routed_create; create(client, model) returns a coroutine."""
+    endpoints = router.ranked(engine)
+    if not endpoints:
+        return await create(get_client(engine, is_async=True, client_retries=False), engine)
+    last_error = None
+    for endpoint in endpoints:
+        started_at = time.time()
+        try:
+            response = await create(get_client(provider=endpoint.provider, is_async=True, client_retries=False), endpoint.model)
+        except openai.APIError as e:
+            if not RetryPolicy.is_retryable(e):
+                raise
+            router.record(endpoint, time.time() - started_at, error=True)
+            last_error = e
+            continue
+        router.record(endpoint, time.time() - started_at, error=False)
+        return response
+    raise last_error
+
+
+class TokenBucket:
+    """Refills capacity_per_minute units per minute, holding at most capacity_per_minute."""
+
+    def __init__(self, capacity_per_minute: float):
+        self.capacity = capacity_per_minute
+        self.rate_per_sec = capacity_per_minute / 60.0
+        self.available = capacity_per_minute
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.rate_per_sec)
+        self.updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        """Takes amount units (the balance may go negative) and returns the seconds
+        to wait until they are actually available. Reservations are served in order."""
+        with self._lock:
+            self._refill()
+            self.available -= amount
+            return max(0.0, -self.available / self.rate_per_sec)
+
+    def refund(self, amount: float):
+        """Gives back over-reserved units (or takes more, if amount is negative)."""
+        with self._lock:
+            self._refill()
+            self.available = min(self.capacity, self.available + amount)
+
+
+class RateLimiter:
+    """Client side requests-per-minute and tokens-per-minute limits of an engine,
+    shared by every caller in the process so that requests are spaced out before
+    the server answers with 429s."""
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def reserve(self, num_tokens: int) -> float:
+        wait_secs = 0.0
+        if self.requests:
+            wait_secs = max(wait_secs, self.requests.reserve(1))
+        if self.tokens:
+            wait_secs = max(wait_secs, self.tokens.reserve(num_tokens))
+        return wait_secs
+
+    def correct(self, estimated_tokens: int, actual_tokens: int):
+        if self.tokens:
+            self.tokens.refund(estimated_tokens - actual_tokens)
+
+
+# engine -> RateLimiter, see set_rate_limit.
+rate_limiters: Dict[str, RateLimiter] = {}
+
+
+def set_rate_limit(engine: str, requests_per_minute: float = None, tokens_per_minute: float = None):
+    """Limits the requests (and tokens) per minute sent to engine by this process."""
+    rate_limiters[engine] = RateLimiter(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute)
+
+
+def estimate_num_tokens(prompt: Union[str, List[str], List[Dict[str, str]]], max_tokens: int, num_completions: int = 1) -> int:
+    """Rough token count of a request as the server counts it against the limit:
+    ~4 characters per prompt token, plus max_tokens for every completion."""
+    if isinstance(prompt, str):
+        num_chars = len(prompt)
+    else:
+        num_chars = sum(len(p) if isinstance(p, str) else len(str(p.get("content", ""))) for p in prompt)
+    return num_chars // 4 + 1 + int(max_tokens) * num_completions
+
+
+def wait_for_rate_limit(engine, prompt, max_tokens, num_completions) -> Tuple[Optional[RateLimiter], int, float]:
+    """Reserves the request on the engine's rate limiter; returns (limiter, estimated tokens, seconds to wait)."""
+    limiter = rate_limiters.get(engine)
+    if limiter is None:
+        return None, 0, 0.0
+    estimated_tokens = estimate_num_tokens(prompt, max_tokens=max_tokens, num_completions=num_completions)
+    return limiter, estimated_tokens, limiter.reserve(estimated_tokens)
+
+
+def correct_rate_limit(limiter: Optional[RateLimiter], estimated_tokens: int, response):
+    usage = getattr(response, "usage", None)
+    if limiter is not None and usage is not None:
+        limiter.correct(estimated_tokens=estimated_tokens, actual_tokens=usage.total_tokens)
+
+
+def refund_rate_limit(limiter: Optional[RateLimiter], estimated_tokens: int):
+    """Gives back the tokens reserved for a request that failed (429, 5xx, ..): the server did not charge them."""
+    if limiter is not None:
+        limiter.correct(estimated_tokens=estimated_tokens, actual_tokens=0)
+
+
+def timeout_option(timeout_secs: Optional[float]) -> Dict:
+    return {"timeout": timeout_secs} if timeout_secs is not None else {}
+
+
 class OpenaiAPIWrapper:
     @staticmethod
-    @retry_with_exponential_backoff
     def call(
         prompt: Union[str, List[str], List[Dict[str, str]]],
         max_tokens: int,
         engine: str,
         stop_token: str,
         temperature: float,
-        num_completions: int = 1
+        num_completions: int = 1,
+        retry_policy: RetryPolicy = None,
+        on_retry_sleep: Callable[[float], None] = None
+    ) -> dict:
+        """Retried (and hedged) by retry_policy, default_retry_policy if None. The request waits for the
+        engine's rate limiter once, before its attempts (the wait is not part of their latency)."""
+        limiter, estimated_tokens, wait_secs = wait_for_rate_limit(engine, prompt, max_tokens, num_completions)
+        if wait_secs > 0:
+            time.sleep(wait_secs)
+        try:
+            response = (retry_policy or default_retry_policy).call(lambda timeout_secs: OpenaiAPIWrapper._call_once(
+                prompt=prompt, max_tokens=max_tokens, engine=engine, stop_token=stop_token,
+                temperature=temperature, num_completions=num_completions, timeout_secs=timeout_secs),
+                on_sleep=on_retry_sleep, latency_key=engine)
+        except Exception:
+            refund_rate_limit(limiter, estimated_tokens)
+            raise
+        correct_rate_limit(limiter, estimated_tokens, response)
+        return response
+
+    @staticmethod
+    def _call_once(
+        prompt: Union[str, List[str], List[Dict[str, str]]],
+        max_tokens: int,
+        engine: str,
+        stop_token: str,
+        temperature: float,
+        num_completions: int = 1,
+        timeout_secs: float = None
     ) -> dict:
-        
         if is_chat_based_agent(engine): # gpt 3.5 onwards.
-            # check if batched requests (list of text prompts) are requested.
-            batched_requested = isinstance(prompt, List) and len(prompt) > 1 and isinstance(prompt[0], str)
-            assert not (batched_requested and is_chat_based_agent(engine)), \
-                f"Open AI does not support batched requests. Check your prompt in the call to OpenaiAPIWrapper."
-            
-            if isinstance(prompt, List):
-                assert len(prompt) >= 1, f"No prompt given as input to call OpenAI API."
-
-            # check if prompt is a list of strings or a list of dictionaries
-            # gpt-3.5-turbo onwards does not support a batched list of prompts.
-            # but, the conversation API does support a list of dictionaries.
-            conversational_content = [{"role": "user", "content": prompt[0]}] if isinstance(prompt, List) and isinstance(prompt[0], str) \
-                        else ([{"role": "user", "content": prompt}] if isinstance(prompt, str) \
-                        else prompt)
-            response = openai_client.chat.completions.create(
-                model=engine,
-                messages=conversational_content,
+            messages = to_chat_messages(prompt)
+            response = routed_create(engine, lambda client, model: client.chat.completions.create(
+                model=model,
+                messages=messages,
                 temperature=temperature,
                 max_tokens=max_tokens,
                 top_p=1,
                 stop=[stop_token],
-                n=num_completions
-            )
+                n=num_completions,
+                **timeout_option(timeout_secs)
+            ))
         else:  # chatgpt onwards.
             response = openai.Completion.create(
                 engine=engine,
@@ -107,9 +377,102 @@ class OpenaiAPIWrapper:
                 # logprobs=3,
                 n=num_completions
             )
+        return response
 
+    @staticmethod
+    async def acall(
+        prompt: Union[str, List[str], List[Dict[str, str]]],
+        max_tokens: int,
+        engine: str,
+        stop_token: str,
+        temperature: float,
+        num_completions: int = 1,
+        retry_policy: RetryPolicy = None,
+        on_retry_sleep: Callable[[float], None] = None
+    ) -> dict:
+        """Awaitable version of call (chat engines only)."""
+        assert is_chat_based_agent(engine), f"acall supports chat based engines only, not {engine}."
+        limiter, estimated_tokens, wait_secs = wait_for_rate_limit(engine, prompt, max_tokens, num_completions)
+        if wait_secs > 0:
+            await asyncio.sleep(wait_secs)
+        try:
+            response = await (retry_policy or default_retry_policy).acall(lambda timeout_secs: OpenaiAPIWrapper._acall_once(
+                prompt=prompt, max_tokens=max_tokens, engine=engine, stop_token=stop_token,
+                temperature=temperature, num_completions=num_completions, timeout_secs=timeout_secs),
+                on_sleep=on_retry_sleep, latency_key=engine)
+        except BaseException:
+            # also when the awaiting task is cancelled.
+            refund_rate_limit(limiter, estimated_tokens)
+            raise
+        correct_rate_limit(limiter, estimated_tokens, response)
         return response
 
+    @staticmethod
+    async def _acall_once(
+        prompt: Union[str, List[str], List[Dict[str, str]]],
+        max_tokens: int,
+        engine: str,
+        stop_token: str,
+        temperature: float,
+        num_completions: int = 1,
+        timeout_secs: float = None
+    ) -> dict:
+        messages = to_chat_messages(prompt)
+        return await async_routed_create(engine, lambda client, model: client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=1,
+            stop=[stop_token],
+            n=num_completions,
+            **timeout_option(timeout_secs)
+        ))
+
+    @staticmethod
+    def call_stream(
+        prompt: Union[str, List[str], List[Dict[str, str]]],
+        max_tokens: int,
+        engine: str,
+        stop_token: str,
+        temperature: float,
+        retry_policy: RetryPolicy = None,
+        on_retry_sleep: Callable[[float], None] = None
+    ) -> Iterator[str]:
+        """Yields the text of a chat completion chunk by chunk, as it arrives (stream=True).
+        Only opening the stream is retried (never hedged)."""
+        assert is_chat_based_agent(engine), f"call_stream supports chat based engines only, not {engine}."
+        limiter, estimated_tokens, wait_secs = wait_for_rate_limit(engine, prompt, max_tokens, 1)
+        if wait_secs > 0:
+            time.sleep(wait_secs)
+        messages = to_chat_messages(prompt)
+        try:
+            stream = (retry_policy or default_retry_policy).call(lambda timeout_secs: routed_create(
+                engine, lambda client, model: client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    top_p=1,
+                    stop=[stop_token],
+                    stream=True,
+                    **timeout_option(timeout_secs)
+                )), hedge=False, on_sleep=on_retry_sleep)
+        except Exception:
+            refund_rate_limit(limiter, estimated_tokens)
+            raise
+        num_chunks = 0
+        try:
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    num_chunks += 1
+                    yield chunk.choices[0].delta.content
+        finally:
+            # also for a broken or abandoned stream; streamed responses carry no usage, a chunk is about a token.
+            if limiter is not None:
+                limiter.correct(estimated_tokens=estimated_tokens,
+                                actual_tokens=estimate_num_tokens(prompt, max_tokens=0) + num_chunks)
+
     @staticmethod
     def get_first_response(response, engine) -> Dict[str, Any]:
         """Returns the first response from the list of responses.
@@ -153,7 +516,9 @@ class OpenaiAPIWrapper:
             for r in response["choices"]:
                 yield r["text"]
 
-    # @staticmethod
-    # def get_all_responses(response, engine) -> Dict[str, Any]:
-    #     """Returns the list of responses."""
-    #     return [choice["text"] for choice in response["choices"]]  # type: ignore
+    @staticmethod
+    def get_all_responses(response, engine) -> List[str]:
+        """Returns the text of every choice (num_completions of them)."""
+        if is_chat_based_agent(engine):
+            return [choice.message.content for choice in response.choices]
+        return [choice["text"] for choice in response["choices"]]  # type: ignore
@@ -1,115 +1,475 @@
-from typing import List
+import asyncio
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import Iterator, List
 
-from gptinference.openai_api import OpenaiAPIWrapper
+from gptinference.metrics import Metrics, cost_of, metrics as default_metrics, price_of
+from gptinference.openai_api import OpenaiAPIWrapper, set_engine_provider, set_rate_limit
+from gptinference.retry_policy import RetryPolicy
+from gptinference.routing import add_route
 from gptinference.utils import newline, shorten
-from gptinference.caching import Caching, OpenAICacheKey, OpenAICacheValue
-from typing import Dict
+from gptinference.caching import CacheBackend, Caching, OpenAICacheKey, OpenAICacheValue, canonical_prompt, legacy_prompt
+from typing import Dict, Optional, Tuple, Union
 
 def cost_in_dollars(num_input_tokens: int, num_output_tokens: int, engine: str) -> float:
-    """Calculate the dollar cost of a completion in dollars.
+    """Calculate the dollar cost of a completion in dollars, from the pricing table in
+       gptinference.metrics (see metrics.load_pricing / metrics.set_price to add engines or update prices).
        See the pricing page for more details: https://openai.com/api/pricing/
     """
-    if engine == "gpt-3.5-turbo":
-        # GPT-3.5-turbo costs $0.50 / 1M input tokens and $1.50 / 1M output tokens
-        return (num_input_tokens * 0.5e-6) + (num_output_tokens * 1.5e-6)
-    elif engine == "gpt-4":
-        # GPT-4 costs $30 / 1M input tokens and $60 / 1M output tokens
-        return (num_input_tokens * 30e-6) + (num_output_tokens * 60e-6)
-    elif engine == "gpt-4-turbo":
-        # GPT-4-turbo costs $10 / 1M input tokens and $30 / 1M output tokens
-        return (num_input_tokens * 10e-6) + (num_output_tokens * 30e-6)
-    elif engine == "gpt-4o":
-        # GPT-4-turbo costs $5 / 1M input tokens and $15 / 1M output tokens
-        return (num_input_tokens * 5e-6) + (num_output_tokens * 15e-6)
-    else:
+    price = price_of(engine)
+    if price is None:
         raise ValueError(f"Pricing unavailable for requested engine: {engine}")
+    return (num_input_tokens * price["input"] + num_output_tokens * price["output"]) / 1e6
+
+
+def usage_of(response) -> Optional[Dict[str, int]]:
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    return {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+
+
+def saved_by_cache(cache_val: OpenAICacheValue, engine: str) -> Dict:
+    """What serving cache_val from the cache avoided: the tokens, dollars and seconds of the api call(s)
+    that produced it (zeros for entries cached without usage / latency)."""
+    usage = cache_val.usage or {}
+    input_tokens, output_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    return {
+        "dollar_cost": cost_of(engine, input_tokens, output_tokens),
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "latency_secs": cache_val.latency_secs or 0.0
+    }
+
+
+def cache_value_of(previous: Optional[OpenAICacheValue], responses: List[str], response, latency_secs: float) -> OpenAICacheValue:
+    """The cache value of responses (previous' cached samples first), with the usage and latency of the
+    api call(s) that produced them."""
+    all_responses = (previous.all_responses if previous else []) + responses
+    usage, previous_usage = usage_of(response), previous.usage if previous else None
+    if usage and previous_usage:
+        usage = {name: usage.get(name, 0) + previous_usage.get(name, 0) for name in ("prompt_tokens", "completion_tokens")}
+    return OpenAICacheValue(first_response=all_responses[0], all_responses=all_responses,
+                            usage=usage or previous_usage,
+                            latency_secs=latency_secs + ((previous.latency_secs or 0.0) if previous else 0.0))
+
+
+def fill_cost_estimator_info(cost_estimator_info_to_fill: Dict, response, engine: str, cache_val: OpenAICacheValue=None):
+    """Fills the dollar cost of an API call into cost_estimator_info_to_fill["cost_in_dollars"].
+       response is None on a cache hit, which costs nothing; what the hit saved (see saved_by_cache)
+       is then filled into cost_estimator_info_to_fill["saved_by_cache"] if cache_val is given.
+    """
+    if cost_estimator_info_to_fill is None:
+        return
+    if response is None:
+        cost_estimator_info_to_fill["cost_in_dollars"] = {
+            "dollar_cost": 0.0,
+            "input_tokens": 0,
+            "output_tokens": 0
+        }
+        if cache_val is not None:
+            cost_estimator_info_to_fill["saved_by_cache"] = saved_by_cache(cache_val, engine)
+        return
+    # response contains the usage information:
+    # "usage": {
+    #     "completion_tokens": 17,
+    #     "prompt_tokens": 57,
+    #     "total_tokens": 74
+    #   }
+    # fill the cost estimator info with the dollar cost of the API call (since it was a cache miss).
+    try:
+        cost = cost_in_dollars(num_input_tokens=response.usage.prompt_tokens,
+                               num_output_tokens=response.usage.completion_tokens,
+                               engine=engine
+                               )
+        cost_estimator_info_to_fill["cost_in_dollars"] = {
+            "dollar_cost": cost,
+            "input_tokens": response.usage.prompt_tokens,
+            "output_tokens": response.usage.completion_tokens
+        }
+    except Exception as e:
+        print(f"Error in filling cost estimator info: {e}. Setting cost to 0.")
+        cost_estimator_info_to_fill["cost_in_dollars"] = {
+            "dollar_cost": 0.0,
+            "input_tokens": 0,
+            "output_tokens": 0
+        }
+
+
+class CacheMissError(BaseException):
+    """Raised by OpenAIWrapper.call on a cache miss inside OpenAIWrapper.cache_only().
+    A BaseException, so that tasks catching Exception around their calls do not swallow it."""
+    pass
 
 
 class OpenAIWrapper:
-        def __init__(self, cache_path:str=None, save_every_n_seconds: int=600):
-            self.cache = Caching(cache_path=cache_path, save_every_n_seconds=save_every_n_seconds)
+        def __init__(self, cache_path:str=None, save_every_n_seconds: int=600, save_every_n_entries: int=100,
+                     lazy_cache: bool=False, hashed_cache_keys: bool=False, keep_prompts_in_cache: bool=False,
+                     cache_backend: Union[str, CacheBackend]="jsonl",
+                     max_memory_entries: int=None, max_memory_bytes: int=None,
+                     rate_limits: Dict[str, Dict[str, float]]=None, engine_providers: Dict[str, str]=None,
+                     routes: Dict[str, List[Tuple[str, str]]]=None, retry_policy: RetryPolicy=None,
+                     near_duplicate_threshold: float=None, metrics: Metrics=None):
+            """cache_backend: "jsonl" (cache_path is an append-only jsonl log), "sqlite" (cache_path is an
+            sqlite db that several processes can share), "packed" (cache_path is a compressed file that stores
+            shared prompt chunks once, see packed_cache) or a CacheBackend instance.
+            max_memory_entries/max_memory_bytes bound an LRU tier of hot entries in front of the backend
+            (the jsonl backend is then lazy; the packed backend keeps every entry in memory and rejects them).
+            The tier is split in stripes, each with its own LRU order, see caching.Caching.
+            rate_limits: engine -> {"requests_per_minute": .., "tokens_per_minute": ..}, see openai_api.set_rate_limit
+            (the limits are shared by all wrappers in the process).
+            engine_providers: engine -> provider name whose (pooled) client serves it, see openai_api.register_provider.
+            routes: logical engine -> [(provider, model), ..] endpoints serving it, see routing.add_route.
+            retry_policy: retries, deadline and hedging of the api calls (openai_api.default_retry_policy if None).
+            near_duplicate_threshold: serve temperature 0 prompts from a cached prompt at least this similar
+            (Jaccard of character shingles), see Caching.
+            metrics: where the calls are counted and timed, and whose hooks are called (metrics.metrics if None)."""
+            self.retry_policy = retry_policy
+            self.metrics = metrics or default_metrics
+            for engine, limits in (rate_limits or {}).items():
+                set_rate_limit(engine=engine, **limits)
+            for engine, provider in (engine_providers or {}).items():
+                set_engine_provider(engine=engine, provider=provider)
+            for engine, endpoints in (routes or {}).items():
+                add_route(engine, endpoints)
+            if cache_backend == "sqlite":
+                from gptinference.sqlite_cache import SqliteCacheBackend
+                cache_backend = SqliteCacheBackend(db_path=cache_path, save_every_n_seconds=save_every_n_seconds,
+                                                   save_every_n_entries=save_every_n_entries,
+                                                   keep_prompts=keep_prompts_in_cache)
+            elif cache_backend == "packed":
+                from gptinference.packed_cache import PackedCacheBackend
+                cache_backend = PackedCacheBackend(cache_path=cache_path, save_every_n_seconds=save_every_n_seconds,
+                                                   save_every_n_entries=save_every_n_entries)
+            elif cache_backend == "jsonl":
+                cache_backend = None
+            self.cache = Caching(cache_path=cache_path, save_every_n_seconds=save_every_n_seconds,
+                                 save_every_n_entries=save_every_n_entries, lazy=lazy_cache,
+                                 hashed_keys=hashed_cache_keys, keep_prompts=keep_prompts_in_cache,
+                                 backend=cache_backend, max_memory_entries=max_memory_entries,
+                                 max_memory_bytes=max_memory_bytes,
+                                 near_duplicate_threshold=near_duplicate_threshold)
+            # cache key -> Future of the api call in flight for it (see _single_flight).
+            self._in_flight: Dict[OpenAICacheKey, Future] = {}
+            self._in_flight_lock = threading.Lock()
+            self.num_coalesced_calls = 0
+            self._local = threading.local()
+
+        @contextmanager
+        def cache_only(self):
+            """Within this block, call raises CacheMissError (in this thread) instead of calling the API."""
+            previous = getattr(self._local, "cache_only", False)
+            self._local.cache_only = True
+            try:
+                yield self
+            finally:
+                self._local.cache_only = previous
 
-        def call(self, prompt, engine, max_tokens=300, stop_token="###", temperature=0.0, cost_estimator_info_to_fill: Dict=None):
+        def call(self, prompt, engine, max_tokens=300, stop_token="###", temperature=0.0, cost_estimator_info_to_fill: Dict=None,
+                 n: int=1):
+            """Returns the response to prompt, or a list of n sampled responses if n > 1.
+            All n choices are requested in one api call and cached under the same key, so later
+            calls asking for up to n samples are served from the cache (only the missing samples
+            are requested when more are asked for)."""
             if not prompt:
-                return ""
-            cache_key = OpenAICacheKey(engine=engine,
-                                       prompt=str(prompt).lstrip(), # don't store new lines in the beginning.
-                                       stop_token=stop_token,
-                                       temperature=temperature,
-                                       max_tokens=max_tokens)
-            cache_val = self.cache.get(key=cache_key)
-            if not cache_val:
+                return "" if n == 1 else []
+            cache_key = self.mk_cache_key(prompt=prompt, engine=engine, max_tokens=max_tokens, stop_token=stop_token,
+                                          temperature=temperature)
+            cache_only = getattr(self._local, "cache_only", False)
+            # a miss of the cache only probe is not counted, the call that follows it is.
+            cache_val = self._lookup(cache_key, n=n, prompt=prompt, record_miss=not cache_only)
+            val_dict = None
+            if (not cache_val or cache_val.num_responses < n) and cache_only:
+                raise CacheMissError(f"Not cached: {cache_key}")
+            if not cache_val or cache_val.num_responses < n:
                 # print(f"\nCalling GPT3: {shorten(prompt, max_words=10)}...")
+                fetch = lambda: self._fetch(cache_key=cache_key, prompt=prompt, engine=engine, max_tokens=max_tokens,
+                                            stop_token=stop_token, temperature=temperature, n=n)
+                # only one request per key is in flight, concurrent callers wait for its result.
+                cache_val, val_dict = self._single_flight(cache_key, fetch)
+                if cache_val.num_responses < n:
+                    # the request we waited for asked for fewer samples.
+                    cache_val, val_dict = fetch()
+            # val_dict is None on a cache hit, so we don't need to call the API and can just return the cached value without any cost.
+            fill_cost_estimator_info(cost_estimator_info_to_fill, response=val_dict, engine=engine, cache_val=cache_val)
+
+            return cache_val.first_response if n == 1 else cache_val.all_responses[:n]
+
+        def _fetch(self, cache_key, prompt, engine, max_tokens, stop_token, temperature, n=1):
+            """Calls the API for the samples missing from the cache (n in total) and caches all of them;
+            returns (cache value, api response or None if they were cached meanwhile)."""
+            # the near-duplicate lookup already missed in _lookup.
+            cache_val = self.cache.get(key=cache_key, near_duplicates=False)
+            if cache_val and cache_val.num_responses >= n:
+                return cache_val, None
+            cached_responses = cache_val.all_responses if cache_val else []
+            self.metrics.before_request(engine=engine, prompt=prompt)
+            started_at = time.time()
+            try:
                 val_dict = OpenaiAPIWrapper.call(prompt=prompt,
                                                  engine=engine,
                                                  max_tokens=max_tokens,
                                                  stop_token=stop_token,
-                                                 temperature=temperature)
-                cache_val = self.cache.set(key=cache_key, value=OpenAICacheValue(
-                    first_response=str(OpenaiAPIWrapper.get_first_response(response=val_dict, engine=engine))
-                ))
-
-                # val_dict contains the usage information:
-                # "usage": {
-                #     "completion_tokens": 17,
-                #     "prompt_tokens": 57,
-                #     "total_tokens": 74
-                #   }
-                # fill the cost estimator info with the dollar cost of the API call (since it was a cache miss).
-                try:
-                    cost = cost_in_dollars(num_input_tokens=val_dict.usage.prompt_tokens,
-                                           num_output_tokens=val_dict.usage.completion_tokens,
-                                           engine=engine
-                                           )
-                    cost_estimator_info_to_fill["cost_in_dollars"] = { 
-                        "dollar_cost": cost,
-                        "input_tokens": val_dict.usage.prompt_tokens,
-                        "output_tokens": val_dict.usage.completion_tokens
-                    }
-                except Exception as e:
-                    print(f"Error in filling cost estimator info: {e}. Setting cost to 0.")
-                    cost_estimator_info_to_fill["cost_in_dollars"] = { 
-                        "dollar_cost": 0.0,
-                        "input_tokens": 0,
-                        "output_tokens": 0
-                    }
-            else:
-                # This is a cache hit so we don't need to call the API and can just return the cached value without any cost.
-                cost_estimator_info_to_fill["cost_in_dollars"] = { 
-                    "dollar_cost": 0.0,
-                    "input_tokens": 0,
-                    "output_tokens": 0
-                }
-
-            return cache_val.first_response
-
-        def mk_cache_key(self, prompt: str, engine: str, max_tokens=300, stop_token="###", temperature=0.0) -> str:
+                                                 temperature=temperature,
+                                                 num_completions=n - len(cached_responses),
+                                                 retry_policy=self.retry_policy,
+                                                 on_retry_sleep=partial(self.metrics.record_retry_sleep, engine))
+            except Exception:
+                self.metrics.record_api_error(engine, latency_secs=time.time() - started_at)
+                raise
+            latency_secs = time.time() - started_at
+            self.metrics.record_response(engine, response=val_dict, latency_secs=latency_secs)
+            responses = [str(r) for r in OpenaiAPIWrapper.get_all_responses(response=val_dict, engine=engine)]
+            cache_val = self.cache.set(key=cache_key, value=cache_value_of(cache_val, responses, val_dict, latency_secs))
+            return cache_val, val_dict
+
+        def _lookup(self, cache_key: OpenAICacheKey, n: int=1, record_miss: bool=True, prompt=None, near_duplicates: bool=True):
+            """cache.get, counted and timed in self.metrics (a hit needs at least n responses).
+            A chat message list prompt missing under its canonical key is looked up under the key older
+            versions used, and moved to the canonical key if found."""
+            started_at = time.time()
+            cache_val = self.cache.get(key=cache_key, near_duplicates=near_duplicates)
+            if not cache_val and isinstance(prompt, list) and legacy_prompt(prompt) != cache_key.prompt:
+                cache_val = self.cache.get(key=OpenAICacheKey(engine=cache_key.engine, prompt=legacy_prompt(prompt),
+                                                              stop_token=cache_key.stop_token,
+                                                              temperature=cache_key.temperature,
+                                                              max_tokens=cache_key.max_tokens),
+                                           near_duplicates=near_duplicates)
+                if cache_val:
+                    self.cache.set(key=cache_key, value=cache_val)
+            hit = bool(cache_val) and cache_val.num_responses >= n
+            if hit or record_miss:
+                self.metrics.record_cache_lookup(cache_key.engine, secs=time.time() - started_at, hit=hit, key=cache_key,
+                                                 value=cache_val if hit else None)
+            return cache_val
+
+        def _single_flight(self, cache_key, fetch):
+            """Runs fetch() unless another thread is already fetching cache_key, in which case
+            waits for that result instead. Returns fetch's (cache value, api response); callers that
+            waited get no api response (they did not pay for it)."""
+            with self._in_flight_lock:
+                future = self._in_flight.get(cache_key)
+                is_leader = future is None
+                if is_leader:
+                    future = self._in_flight[cache_key] = Future()
+                else:
+                    self.num_coalesced_calls += 1
+            if not is_leader:
+                return future.result()[0], None
+            try:
+                result = fetch()
+                future.set_result(result)
+                return result
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with self._in_flight_lock:
+                    del self._in_flight[cache_key]
+
+        def call_stream(self, prompt, engine, max_tokens=300, stop_token="###", temperature=0.0,
+                        stream_stats_to_fill: Dict=None) -> Iterator[str]:
+            """Yields the response to prompt chunk by chunk as the API streams it; the assembled response
+            is cached once the stream is complete. A cached response is replayed as a single chunk.
+            stream_stats_to_fill gets cache_hit, time_to_first_token_secs, total_secs, num_chunks
+            and tokens_per_sec (a streamed chunk is about a token)."""
+            stats = stream_stats_to_fill if stream_stats_to_fill is not None else {}
+            if not prompt:
+                return
+            started_at = time.time()
+            cache_key = self.mk_cache_key(prompt=prompt, engine=engine, max_tokens=max_tokens, stop_token=stop_token,
+                                          temperature=temperature)
+            cache_val = self._lookup(cache_key, prompt=prompt)
+            stats["cache_hit"] = bool(cache_val)
+            if cache_val:
+                stats["time_to_first_token_secs"] = time.time() - started_at
+                yield cache_val.first_response
+                stats.update(total_secs=time.time() - started_at, num_chunks=1, tokens_per_sec=0.0)
+                return
+
+            chunks = []
+            self.metrics.before_request(engine=engine, prompt=prompt)
+            api_started_at = time.time()
+            try:
+                for chunk in OpenaiAPIWrapper.call_stream(prompt=prompt, engine=engine, max_tokens=max_tokens,
+                                                          stop_token=stop_token, temperature=temperature,
+                                                          retry_policy=self.retry_policy,
+                                                          on_retry_sleep=partial(self.metrics.record_retry_sleep, engine)):
+                    if not chunks:
+                        stats["time_to_first_token_secs"] = time.time() - started_at
+                    chunks.append(chunk)
+                    yield chunk
+            except Exception:
+                self.metrics.record_api_error(engine, latency_secs=time.time() - api_started_at)
+                raise
+            # streamed responses carry no usage, only the call and its latency are counted (and cached).
+            api_secs = time.time() - api_started_at
+            self.metrics.record_response(engine, response=None, latency_secs=api_secs)
+            total_secs = time.time() - started_at
+            generation_secs = total_secs - stats.get("time_to_first_token_secs", total_secs)
+            stats.update(total_secs=total_secs, num_chunks=len(chunks),
+                         tokens_per_sec=len(chunks) / generation_secs if generation_secs > 0 else 0.0)
+            # a stream abandoned by the caller never gets here, so partial responses are not cached.
+            if chunks:
+                self.cache.set(key=cache_key, value=OpenAICacheValue(first_response="".join(chunks), latency_secs=api_secs))
+
+        def mk_cache_key(self, prompt: Union[str, List[str], List[Dict[str, str]]], engine: str, max_tokens=300,
+                         stop_token="###", temperature=0.0) -> OpenAICacheKey:
+            """The cache key of a text or chat message list prompt (see caching.canonical_prompt)."""
             cache_key = OpenAICacheKey(engine=engine,
-                                  prompt=prompt.lstrip(), # don't store new lines in the beginning.
+                                  prompt=canonical_prompt(prompt),
                                   stop_token=stop_token,
                                   temperature=temperature,
                                   max_tokens=max_tokens)
             return cache_key
 
 
-        def call_batch(self, prompts: List[str], engine: str, max_tokens=300, stop_token="###", temperature=0.0):
-            cache_keys = [self.mk_cache_key(prompt=prompt, engine=engine, stop_token=stop_token, temperature=temperature, max_tokens=max_tokens)  for prompt in prompts]
-            precached_entries = {prompt: self.cache.get(key=cache_key) for cache_key, prompt in zip(cache_keys, prompts)}
-            uncached_prompts   = [prompt for prompt, cached_entry in precached_entries.items() if not cached_entry]
+        def call_batch(self, prompts: List[str], engine: str, max_tokens=300, stop_token="###", temperature=0.0,
+                       max_concurrency: int=8, cost_estimator_infos_to_fill: List[Dict]=None) -> List[str]:
+            """Calls the API for the uncached prompts concurrently (at most max_concurrency requests in flight;
+            chat models do not accept a batch of prompts in one request).
+            Returns the responses in input order; every response is cached. If cost_estimator_infos_to_fill
+            is given, it is extended with one cost estimator info dict per prompt (see call)."""
+            cost_infos = [{} for _ in prompts]
+            responses = [None] * len(prompts)
+            uncached_ids = []
+            # uncached prompts sharing a cache key are requested once: key -> first index.
+            first_id_of_key = {}
+            duplicate_ids = []
+            for i, prompt in enumerate(prompts):
+                cache_key = self.mk_cache_key(prompt=prompt, engine=engine, stop_token=stop_token, temperature=temperature, max_tokens=max_tokens)
+                # misses are counted by the call below, which also does the (only) near-duplicate lookup.
+                cached_entry = self._lookup(cache_key, record_miss=False, prompt=prompt, near_duplicates=False)
+                if cached_entry:
+                    responses[i] = cached_entry.first_response
+                    fill_cost_estimator_info(cost_infos[i], response=None, engine=engine, cache_val=cached_entry)
+                elif cache_key in first_id_of_key:
+                    duplicate_ids.append((i, first_id_of_key[cache_key]))
+                else:
+                    first_id_of_key[cache_key] = i
+                    uncached_ids.append(i)
+
+            # print(f"\nCalling GPT3 as a batch for ({len(uncached_ids)}/ {len(prompts)}) "
+            #       f"prompts: {(newline+newline).join([shorten(prompts[i], max_words=10)+ '...' for i in uncached_ids])}")
+
+            if uncached_ids:
+                with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(uncached_ids)))) as pool:
+                    futures = {i: pool.submit(self.call, prompt=prompts[i], engine=engine, max_tokens=max_tokens,
+                                              stop_token=stop_token, temperature=temperature,
+                                              cost_estimator_info_to_fill=cost_infos[i])
+                               for i in uncached_ids}
+                    for i, future in futures.items():
+                        responses[i] = future.result()
+                for i, first_id in duplicate_ids:
+                    responses[i] = responses[first_id]
+                    cache_val = self.cache.get(key=self.mk_cache_key(prompt=prompts[i], engine=engine, stop_token=stop_token,
+                                                                     temperature=temperature, max_tokens=max_tokens))
+                    fill_cost_estimator_info(cost_infos[i], response=None, engine=engine, cache_val=cache_val)
+                    self.metrics.record_cache_lookup(engine, secs=0.0, hit=True, value=cache_val)
 
-            # print(f"\nCalling GPT3 as a batch for ({len(uncached_prompts)}/ {len(precached_entries)}) "
-            #       f"prompts: {(newline+newline).join([shorten(p, max_words=10)+ '...' for p in uncached_prompts])}")
+            if cost_estimator_infos_to_fill is not None:
+                cost_estimator_infos_to_fill.extend(cost_infos)
+            return responses
 
-            batched_response = OpenaiAPIWrapper.call(prompt=uncached_prompts,
+
+class AsyncOpenAIWrapper(OpenAIWrapper):
+        """OpenAIWrapper for asyncio code: call and call_batch are awaitable and never block the event loop.
+        Shares the caching semantics of OpenAIWrapper (Caching.get/set are thread safe and set never
+        waits on disk, the background flusher writes). Cache lookups that read the disk (lazy jsonl,
+        sqlite) or compute near-duplicate signatures run on the loop's default executor."""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            # cache key -> task of the api call in flight for it, on the event loop.
+            self._in_flight_tasks: Dict[OpenAICacheKey, asyncio.Future] = {}
+            # per task rather than per thread, all tasks share the loop's thread.
+            self._cache_only = contextvars.ContextVar(f"cache_only_{id(self)}", default=False)
+
+        @contextmanager
+        def cache_only(self):
+            """Within this block, call raises CacheMissError (in this task, and the tasks it starts)
+            instead of calling the API."""
+            token = self._cache_only.set(True)
+            try:
+                yield self
+            finally:
+                self._cache_only.reset(token)
+
+        async def _off_loop(self, fn):
+            """fn(), on the default executor unless the cache only touches memory (see Caching.gets_from_memory)."""
+            if self.cache.gets_from_memory:
+                return fn()
+            return await asyncio.get_running_loop().run_in_executor(None, fn)
+
+        async def call(self, prompt, engine, max_tokens=300, stop_token="###", temperature=0.0, cost_estimator_info_to_fill: Dict=None,
+                       n: int=1):
+            if not prompt:
+                return "" if n == 1 else []
+            cache_key = self.mk_cache_key(prompt=prompt, engine=engine, max_tokens=max_tokens, stop_token=stop_token,
+                                          temperature=temperature)
+            cache_only = self._cache_only.get()
+            cache_val = await self._off_loop(partial(self._lookup, cache_key, n=n, prompt=prompt, record_miss=not cache_only))
+            val_dict = None
+            if (not cache_val or cache_val.num_responses < n) and cache_only:
+                raise CacheMissError(f"Not cached: {cache_key}")
+            while not cache_val or cache_val.num_responses < n:
+                # only one request per key is in flight, concurrent callers await its result
+                # (and request again if it asked for fewer samples).
+                future = self._in_flight_tasks.get(cache_key)
+                if future is None:
+                    future = self._in_flight_tasks[cache_key] = asyncio.ensure_future(self._fetch_async(
+                        cache_key=cache_key, prompt=prompt, engine=engine, max_tokens=max_tokens,
+                        stop_token=stop_token, temperature=temperature, n=n))
+                    future.add_done_callback(lambda _: self._in_flight_tasks.pop(cache_key, None))
+                    cache_val, val_dict = await asyncio.shield(future)
+                else:
+                    self.num_coalesced_calls += 1
+                    cache_val, _ = await asyncio.shield(future)
+            fill_cost_estimator_info(cost_estimator_info_to_fill, response=val_dict, engine=engine, cache_val=cache_val)
+            return cache_val.first_response if n == 1 else cache_val.all_responses[:n]
+
+        async def _fetch_async(self, cache_key, prompt, engine, max_tokens, stop_token, temperature, n=1):
+            cache_val = await self._off_loop(partial(self.cache.get, key=cache_key, near_duplicates=False))
+            if cache_val and cache_val.num_responses >= n:
+                return cache_val, None
+            cached_responses = cache_val.all_responses if cache_val else []
+            self.metrics.before_request(engine=engine, prompt=prompt)
+            started_at = time.time()
+            try:
+                val_dict = await OpenaiAPIWrapper.acall(prompt=prompt,
                                                         engine=engine,
-                                                        max_tokens=max_tokens, stop_token=stop_token,
-                                                        temperature=temperature)
+                                                        max_tokens=max_tokens,
+                                                        stop_token=stop_token,
+                                                        temperature=temperature,
+                                                        num_completions=n - len(cached_responses),
+                                                        retry_policy=self.retry_policy,
+                                                        on_retry_sleep=partial(self.metrics.record_retry_sleep, engine))
+            except Exception:
+                self.metrics.record_api_error(engine, latency_secs=time.time() - started_at)
+                raise
+            latency_secs = time.time() - started_at
+            self.metrics.record_response(engine, response=val_dict, latency_secs=latency_secs)
+            responses = [str(r) for r in OpenaiAPIWrapper.get_all_responses(response=val_dict, engine=engine)]
+            cache_val = await self._off_loop(partial(self.cache.set, key=cache_key,
+                                                     value=cache_value_of(cache_val, responses, val_dict, latency_secs)))
+            return cache_val, val_dict
 
-            for prompt, completion in zip(uncached_prompts, OpenaiAPIWrapper.get_first_response_batched(response=batched_response, engine=engine)):
-                value = OpenAICacheValue(first_response= completion.strip())
-                precached_entries[prompt] = value
-                cache_key = self.mk_cache_key(prompt=prompt, engine=engine, stop_token=stop_token, temperature=temperature, max_tokens=max_tokens)
-                self.cache.set(key=cache_key, value=value)
+        async def call_batch(self, prompts: List[str], engine: str, max_tokens=300, stop_token="###", temperature=0.0,
+                             max_concurrency: int=8, cost_estimator_infos_to_fill: List[Dict]=None) -> List[str]:
+            """Same as OpenAIWrapper.call_batch, with at most max_concurrency requests in flight on the event loop."""
+            cost_infos = [{} for _ in prompts]
+            semaphore = asyncio.Semaphore(max(1, max_concurrency))
 
-            return [p.first_response for _, p in precached_entries.items()]
+            async def call_one(prompt, cost_info):
+                async with semaphore:
+                    return await self.call(prompt=prompt, engine=engine, max_tokens=max_tokens, stop_token=stop_token,
+                                           temperature=temperature, cost_estimator_info_to_fill=cost_info)
 
+            responses = await asyncio.gather(*[call_one(prompt, cost_info) for prompt, cost_info in zip(prompts, cost_infos)])
+            if cost_estimator_infos_to_fill is not None:
+                cost_estimator_infos_to_fill.extend(cost_infos)
+            return list(responses)
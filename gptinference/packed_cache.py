@@ -0,0 +1,256 @@
+import hashlib
+import json
+import os
+import re
+import struct
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from gptinference.caching import CacheBackend, DigestKey, OpenAICacheKey, OpenAICacheValue, read_records, record_digest
+
+MAGIC = b"gptinference packed cache v1\n"
+FRAME_HEADER = struct.Struct(">I")
+
+
+def split_prompt(prompt: str, min_chunk_chars: int = 64) -> List[str]:
+    """Splits prompt after every blank line (the separators of Prompt: few-shot examples,
+    instructions, abstracts, ..), merging pieces shorter than min_chunk_chars into the next one.
+    The same prefix always splits into the same chunks."""
+    chunks, current = [], ""
+    for piece in re.split(r"(?<=\n\n)", prompt):
+        current += piece
+        if len(current) >= min_chunk_chars:
+            chunks.append(current)
+            current = ""
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_id(chunk: str) -> str:
+    return hashlib.blake2b(chunk.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def is_torn_tail(payload: bytes) -> bool:
+    """Whether payload, cut short by the end of the file, is the start of a single zlib stream
+    (what a crash while appending the last frame leaves behind) rather than the bytes of
+    other frames read because of a corrupt length header."""
+    decompressor = zlib.decompressobj()
+    try:
+        decompressor.decompress(payload)
+    except zlib.error:
+        return False
+    return not decompressor.eof
+
+
+def decompress_frame(payload: bytes) -> List[Dict]:
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(payload)
+    if not decompressor.eof or decompressor.unused_data:
+        raise zlib.error("the frame is not exactly one zlib stream")
+    return [json.loads(line) for line in data.decode("utf-8").splitlines()]
+
+
+def read_frames(fp: str) -> Iterator[Tuple[int, List[Dict]]]:
+    """Streams (end offset, records) of every complete frame of a packed cache file.
+    Stops at a torn last frame; raises ValueError on a corrupt frame anywhere else."""
+    with open(fp, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"caching: {fp} is not a packed cache file.")
+        while True:
+            offset = f.tell()
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                if header:
+                    print(f"\nCaching: skipping the torn frame at the end of {fp}")
+                return
+            (size,) = FRAME_HEADER.unpack(header)
+            payload = f.read(size)
+            if len(payload) < size and is_torn_tail(payload):
+                # a crash while appending can leave a torn last frame; stop there.
+                print(f"\nCaching: skipping the torn frame at the end of {fp}")
+                return
+            try:
+                if len(payload) < size:
+                    raise zlib.error(f"frame of {size} bytes runs past the end of the file")
+                records = decompress_frame(payload)
+            except (zlib.error, ValueError) as e:
+                raise ValueError(f"caching: corrupt frame at offset {offset} of {fp} ({e}).") from e
+            yield f.tell(), records
+
+
+class PackedCacheBackend(CacheBackend):
+    """
+    Compact cache file for few-shot prompts, which share long prefixes (instructions, examples)
+    across thousands of entries. Prompts are split into chunks (see split_prompt) that are stored
+    once, content-addressed by their hash; entries only list their chunk ids. Every flush appends
+    one zlib compressed frame of jsonl records, so loading streams and decompresses the file frame
+    by frame. Only digest -> value is kept in memory (no prompts).
+
+    compression_stats (and compression_ratio) report the size of the same entries as a JSONL cache
+    against the packed size; see export_jsonl / import_jsonl to convert between the two formats.
+    """
+
+    def __init__(self, cache_path: str, save_every_n_seconds = 600,
+                 save_every_n_entries: int = 100,
+                 min_chunk_chars: int = 64,
+                 compression_level: int = 6):
+        super().__init__(save_every_n_seconds=save_every_n_seconds, save_every_n_entries=save_every_n_entries)
+        assert cache_path is not None, f"\n\ncaching openai: cache file is empty."
+        self.cache_path: str = cache_path.strip()
+        self.min_chunk_chars = min_chunk_chars
+        self.compression_level = compression_level
+        self.cache: Dict[bytes, OpenAICacheValue] = {}
+        # ids of the chunks already in the file.
+        self._chunk_ids = set()
+
+        print(f"\nCaching: Loading packed cache from {self.cache_path}", end=" ... ")
+        good_end = len(MAGIC)
+        if not os.path.exists(self.cache_path) or os.path.getsize(self.cache_path) == 0:
+            with open(self.cache_path, 'wb') as f:
+                f.write(MAGIC)
+        for good_end, records in read_frames(self.cache_path):
+            for j in records:
+                if "c" in j:
+                    self._chunk_ids.add(j["c"])
+                else:
+                    self.cache[bytes.fromhex(j["key"])] = OpenAICacheValue.from_json(j)
+        if os.path.getsize(self.cache_path) > good_end:
+            os.truncate(self.cache_path, good_end)
+        self._log = open(self.cache_path, 'ab')
+        self.start()
+        print(f"[done]")
+
+    @property
+    def num_entries(self) -> int:
+        return len(self.cache)
+
+    @property
+    def compression_ratio(self) -> float:
+        """JSONL size / packed size of the entries flushed so far; reads the whole file, see compression_stats."""
+        with self._io_lock:
+            return compression_stats(self.cache_path)["compression_ratio"]
+
+    @property
+    def in_memory(self) -> bool:
+        return True
+
+    @property
+    def stores_prompts(self) -> bool:
+        return True
+
+    def get(self, key: OpenAICacheKey) -> Optional[OpenAICacheValue]:
+        return self.cache.get(key.digest())
+
+    def remember(self, key: OpenAICacheKey, value: OpenAICacheValue):
+        self.cache[key.digest()] = value
+
+    def iter_keys(self) -> Iterator[OpenAICacheKey]:
+        for j in read_packed(self.cache_path):
+            if "prompt" in j:
+                yield OpenAICacheKey.from_json(j)
+
+    def pack_records(self, entries: List[Tuple[OpenAICacheKey, OpenAICacheValue]]) -> Tuple[List[Dict], set]:
+        """The chunks not yet stored and one record per entry, and the ids of those new chunks
+        (only added to _chunk_ids once the frame is written). Called under _io_lock."""
+        records, new_chunk_ids = [], set()
+        for key, value in entries:
+            j = {"key": key.digest().hex()}
+            if key.prompt is not None:
+                ids = []
+                for chunk in split_prompt(key.prompt, self.min_chunk_chars):
+                    c = chunk_id(chunk)
+                    if c not in self._chunk_ids and c not in new_chunk_ids:
+                        new_chunk_ids.add(c)
+                        records.append({"c": c, "t": chunk})
+                    ids.append(c)
+                j.update(key.to_json())
+                j["prompt"] = ids
+            j.update(value.to_json())
+            records.append(j)
+        return records, new_chunk_ids
+
+    def write_batch(self, entries: List[Tuple[OpenAICacheKey, OpenAICacheValue]]) -> int:
+        if self._log.closed:
+            return 0
+        records, new_chunk_ids = self.pack_records(entries)
+        payload = zlib.compress("\n".join(json.dumps(j) for j in records).encode("utf-8"), self.compression_level)
+        end = self._log.tell()
+        try:
+            self._log.write(FRAME_HEADER.pack(len(payload)) + payload)
+            self._log.flush()
+            os.fsync(self._log.fileno())
+        except Exception:
+            # drop the partial frame, so that the next one is not appended after garbage.
+            try:
+                self._log.close()
+            except OSError:
+                pass
+            os.truncate(self.cache_path, end)
+            self._log = open(self.cache_path, 'ab')
+            raise
+        self._chunk_ids |= new_chunk_ids
+        return FRAME_HEADER.size + len(payload)
+
+
+def read_packed(fp: str) -> Iterator[Dict]:
+    """Streams the records of a packed cache file as JSONL cache records (prompts reassembled)."""
+    chunks: Dict[str, str] = {}
+    for _, records in read_frames(fp):
+        for j in records:
+            if "c" in j:
+                chunks[j["c"]] = j["t"]
+                continue
+            if isinstance(j.get("prompt"), list):
+                j["prompt"] = "".join(chunks[c] for c in j["prompt"])
+                # the digest of a key with its prompt is not stored in JSONL caches.
+                del j["key"]
+            yield j
+
+
+def compression_stats(fp: str) -> Dict:
+    """Size of the entries of packed cache file fp as a JSONL cache vs its size, and their ratio."""
+    jsonl_bytes, num_records = 0, 0
+    for j in read_packed(fp):
+        jsonl_bytes += len((json.dumps(j) + "\n").encode("utf-8"))
+        num_records += 1
+    packed_bytes = os.path.getsize(fp)
+    return {"num_records": num_records, "jsonl_bytes": jsonl_bytes, "packed_bytes": packed_bytes,
+            "compression_ratio": jsonl_bytes / packed_bytes if packed_bytes else 0.0}
+
+
+def export_jsonl(packed_path: str, jsonl_path: str) -> int:
+    """Writes the entries of a packed cache as a JSONL cache (later records of a key win on load)."""
+    num_records = 0
+    with open(jsonl_path, 'wb') as out:
+        for j in read_packed(packed_path):
+            out.write((json.dumps(j) + "\n").encode("utf-8"))
+            num_records += 1
+    return num_records
+
+
+def import_jsonl(jsonl_path: str, packed_path: str, records_per_frame: int = 1000, **config) -> int:
+    """Writes the latest record of every key of a JSONL cache (legacy or current, hashed or not)
+    into a new packed cache file."""
+    latest = {record_digest(j): offset for offset, j in read_records(jsonl_path)}
+    backend = PackedCacheBackend(cache_path=packed_path, save_every_n_seconds=10 ** 9,
+                                 save_every_n_entries=10 ** 9, **config)
+    batch = []
+    for offset, j in read_records(jsonl_path):
+        digest = record_digest(j)
+        if latest.get(digest) != offset:
+            continue
+        if "prompt" in j:
+            key = OpenAICacheKey.from_json(j)
+            key.prompt = key.prompt.lstrip()
+        else:
+            # only the digest is known, see DigestKey.
+            key = DigestKey(digest)
+        batch.append((key, OpenAICacheValue.from_json(j)))
+        if len(batch) >= records_per_frame:
+            backend.write_batch(batch)
+            batch = []
+    if batch:
+        backend.write_batch(batch)
+    backend.cleanup()
+    return len(latest)
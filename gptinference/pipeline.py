@@ -0,0 +1,65 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterable, Iterator
+
+from gptinference.openai_wrapper import CacheMissError, OpenAIWrapper
+
+
+def _run(task: Callable, x: Any):
+    # an input is a dict of keyword arguments of the task, or its single argument.
+    return task(**x) if isinstance(x, dict) else task(x)
+
+
+def map_stream(task: Callable, inputs: Iterable, window: int = 8, ordered: bool = True,
+               openai_wrapper: OpenAIWrapper = None) -> Iterator:
+    """
+    Lazily yields task(x) for every x of inputs, e.g. for a Prompt task:
+
+        for relation, takeaway in map_stream(AbstractTakeawayForClaimTask(...), ({"claim": c, "abstract": a} for c, a in rows)):
+            ...
+
+    At most `window` inputs are in flight (including finished ones waiting for an earlier
+    input in ordered mode), and the next input is only pulled from `inputs` when one of
+    them is yielded, so memory stays constant however long `inputs` is. With ordered=False
+    outputs are yielded in completion order.
+
+    Every input is first run on the calling thread in openai_wrapper.cache_only() mode (by
+    default the task's own openai_wrapper), so fully cached inputs never reach the thread pool;
+    the others run on `window` worker threads.
+    """
+    openai_wrapper = openai_wrapper or getattr(task, "openai_wrapper", None)
+    in_flight = deque()
+    inputs = iter(inputs)
+    exhausted = False
+    pool = ThreadPoolExecutor(max_workers=max(1, window))
+
+    def submit(x) -> Future:
+        if openai_wrapper is not None:
+            try:
+                with openai_wrapper.cache_only():
+                    done = Future()
+                    done.set_result(_run(task, x))
+                    return done
+            except CacheMissError:
+                pass
+        return pool.submit(_run, task, x)
+
+    try:
+        while True:
+            while not exhausted and len(in_flight) < window:
+                try:
+                    in_flight.append(submit(next(inputs)))
+                except StopIteration:
+                    exhausted = True
+            if not in_flight:
+                return
+            if ordered:
+                yield in_flight.popleft().result()
+            else:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.remove(future)
+                for future in done:
+                    yield future.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
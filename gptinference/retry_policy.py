@@ -0,0 +1,248 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Optional
+
+import openai
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+def run_into(future: Future, fn: Callable, *args):
+    try:
+        future.set_result(fn(*args))
+    except BaseException as e:
+        future.set_exception(e)
+
+
+class RetryPolicy:
+    """
+    How a request to the API is retried and hedged.
+
+    - retries: rate limits, timeouts, connection errors and 5xx responses are retried up to
+      max_retries times, sleeping with capped decorrelated jitter
+      (min(max_delay_secs, uniform(initial_delay_secs, 3 * previous sleep))), or longer if the
+      server asked for it with a Retry-After header.
+    - deadline: with deadline_secs, a request (all its attempts and sleeps) gives up with
+      DeadlineExceededError after that long; every attempt is sent with the remaining time as
+      its timeout.
+    - hedging: with hedge_percentile (e.g. 95), when an attempt takes longer than that percentile
+      of the recent latencies, a duplicate request is sent and the first response wins. The
+      loser is cancelled (sync calls can not be interrupted, their response is discarded).
+      Hedges run on a pool of max_hedge_workers threads. Latencies are kept per latency_key
+      (the engine), so a fast engine is not hedged by the percentile of a slow one; calls with
+      hedge=False (e.g. opening a stream) do not record theirs.
+    """
+
+    def __init__(self, max_retries: int = 10, initial_delay_secs: float = 1, max_delay_secs: float = 60,
+                 deadline_secs: float = None, hedge_percentile: float = None, hedge_min_samples: int = 20,
+                 latency_window: int = 200, max_hedge_workers: int = 32):
+        self.max_retries = max_retries
+        self.initial_delay_secs = initial_delay_secs
+        self.max_delay_secs = max_delay_secs
+        self.deadline_secs = deadline_secs
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.max_hedge_workers = max_hedge_workers
+        self.latency_window = latency_window
+        # latency_key -> the latencies of its last latency_window attempts.
+        self.latencies: Dict[str, deque] = {}
+        self.stats = {"num_requests": 0, "num_retries": 0, "num_hedges": 0, "num_hedge_wins": 0,
+                      "num_deadlines_exceeded": 0, "total_sleep_secs": 0.0}
+        self._lock = threading.Lock()
+        self._hedge_pool = None
+
+    @staticmethod
+    def is_retryable(e: Exception) -> bool:
+        if isinstance(e, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+            return True
+        return isinstance(e, openai.APIStatusError) and getattr(e, "status_code", 0) >= 500
+
+    @staticmethod
+    def retry_after_secs(e: Exception) -> float:
+        """The wait the server asked for (Retry-After / retry-after-ms headers), 0 if none."""
+        headers = getattr(getattr(e, "response", None), "headers", None) or {}
+        try:
+            if headers.get("retry-after-ms") is not None:
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after") is not None:
+                return float(headers["retry-after"])
+        except ValueError:
+            pass  # an http date, not worth parsing.
+        return 0.0
+
+    def next_delay(self, previous_delay: float, e: Exception) -> float:
+        delay = min(self.max_delay_secs, random.uniform(self.initial_delay_secs, max(self.initial_delay_secs, previous_delay * 3)))
+        return max(delay, self.retry_after_secs(e))
+
+    def hedge_after_secs(self, latency_key: str = None) -> Optional[float]:
+        if not self.hedge_percentile:
+            return None
+        with self._lock:
+            latencies = self.latencies.get(latency_key)
+            if latencies is None or len(latencies) < self.hedge_min_samples:
+                return None
+            latencies = sorted(latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))]
+
+    def _record(self, key: str, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _record_latency(self, latency_key: str, latency_secs: float):
+        with self._lock:
+            if latency_key not in self.latencies:
+                self.latencies[latency_key] = deque(maxlen=self.latency_window)
+            self.latencies[latency_key].append(latency_secs)
+
+    def _remaining(self, started_at: float) -> Optional[float]:
+        if self.deadline_secs is None:
+            return None
+        remaining = self.deadline_secs - (time.time() - started_at)
+        if remaining <= 0:
+            self._record("num_deadlines_exceeded")
+            raise DeadlineExceededError(f"Request did not succeed within {self.deadline_secs} secs.")
+        return remaining
+
+    def call(self, fn: Callable, hedge: bool = True, on_sleep: Callable = None, latency_key: str = None):
+        """Runs fn(timeout_secs) under this policy and returns its result; on_sleep(secs) is called before each retry sleep.
+        Hedged by (and recorded in) the latencies of latency_key."""
+        self._record("num_requests")
+        started_at = time.time()
+        num_retries = 0
+        delay = self.initial_delay_secs
+        while True:
+            timeout_secs = self._remaining(started_at)
+            try:
+                return self._attempt(fn, timeout_secs, hedge=hedge, latency_key=latency_key)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    raise e
+                num_retries += 1
+                if num_retries > self.max_retries:
+                    raise Exception(f"Maximum number of retries ({self.max_retries}) exceeded.") from e
+                self._record("num_retries")
+                delay = self.next_delay(delay, e)
+                remaining = self._remaining(started_at)
+                if remaining is not None and delay >= remaining:
+                    self._record("num_deadlines_exceeded")
+                    raise DeadlineExceededError(f"Request did not succeed within {self.deadline_secs} secs.") from e
+                self._record("total_sleep_secs", delay)
+                if on_sleep is not None:
+                    on_sleep(delay)
+                time.sleep(delay)
+
+    def _attempt(self, fn: Callable, timeout_secs: Optional[float], hedge: bool, latency_key: str):
+        if not hedge:
+            return fn(timeout_secs)
+        attempt_started_at = time.time()
+        hedge_after_secs = self.hedge_after_secs(latency_key)
+        if hedge_after_secs is None:
+            result = fn(timeout_secs)
+        else:
+            result = self._hedged_attempt(fn, timeout_secs, hedge_after_secs)
+        self._record_latency(latency_key, time.time() - attempt_started_at)
+        return result
+
+    def _hedged_attempt(self, fn: Callable, timeout_secs: Optional[float], hedge_after_secs: float):
+        # the primary starts right away on a thread of its own, so it is never queued behind other
+        # calls (queued time would count as latency) and a winning hedge does not wait for it;
+        # only the hedges share the bounded pool.
+        first = Future()
+        threading.Thread(target=run_into, args=(first, fn, timeout_secs), daemon=True).start()
+        done, _ = wait([first], timeout=hedge_after_secs)
+        if done:
+            return first.result()
+        with self._lock:
+            if self._hedge_pool is None:
+                self._hedge_pool = ThreadPoolExecutor(max_workers=self.max_hedge_workers)
+        self._record("num_hedges")
+        hedged = self._hedge_pool.submit(fn, timeout_secs)
+        pending = {first, hedged}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedged:
+                        self._record("num_hedge_wins")
+                    for loser in pending:
+                        loser.cancel()
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    async def acall(self, afn: Callable, hedge: bool = True, on_sleep: Callable = None, latency_key: str = None):
+        """Awaitable version of call: afn(timeout_secs) returns a coroutine."""
+        self._record("num_requests")
+        started_at = time.time()
+        num_retries = 0
+        delay = self.initial_delay_secs
+        while True:
+            timeout_secs = self._remaining(started_at)
+            try:
+                return await self._aattempt(afn, timeout_secs, hedge=hedge, latency_key=latency_key)
+            except Exception as e:
+                if not self.is_retryable(e):
+                    raise e
+                num_retries += 1
+                if num_retries > self.max_retries:
+                    raise Exception(f"Maximum number of retries ({self.max_retries}) exceeded.") from e
+                self._record("num_retries")
+                delay = self.next_delay(delay, e)
+                remaining = self._remaining(started_at)
+                if remaining is not None and delay >= remaining:
+                    self._record("num_deadlines_exceeded")
+                    raise DeadlineExceededError(f"Request did not succeed within {self.deadline_secs} secs.") from e
+                self._record("total_sleep_secs", delay)
+                if on_sleep is not None:
+                    on_sleep(delay)
+                await asyncio.sleep(delay)
+
+    async def _aattempt(self, afn: Callable, timeout_secs: Optional[float], hedge: bool, latency_key: str):
+        if not hedge:
+            return await afn(timeout_secs)
+        attempt_started_at = time.time()
+        hedge_after_secs = self.hedge_after_secs(latency_key)
+        if hedge_after_secs is None:
+            result = await afn(timeout_secs)
+        else:
+            first = asyncio.ensure_future(afn(timeout_secs))
+            done, _ = await asyncio.wait({first}, timeout=hedge_after_secs)
+            if done:
+                result = first.result()
+            else:
+                self._record("num_hedges")
+                hedged = asyncio.ensure_future(afn(timeout_secs))
+                result = await self._first_success(first, hedged)
+        self._record_latency(latency_key, time.time() - attempt_started_at)
+        return result
+
+    async def _first_success(self, first, hedged):
+        pending = {first, hedged}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedged:
+                            self._record("num_hedge_wins")
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            latency_keys = list(self.latencies)
+        hedge_after_secs = {latency_key: self.hedge_after_secs(latency_key) for latency_key in latency_keys}
+        with self._lock:
+            return dict(self.stats, hedge_after_secs=hedge_after_secs)
@@ -0,0 +1,115 @@
+"""
+Latency aware routing of a logical model over several OpenAI compatible endpoints serving it,
+e.g. an open model served by two providers:
+
+    add_route("mixtral", [("together", "mistralai/Mixtral-8x7B-Instruct-v0.1"),
+                          ("local", "mixtral-8x7b")])  # providers, see openai_api.register_provider
+
+OpenaiAPIWrapper.call(engine="mixtral", ...) then sends each request to the fastest healthy
+endpoint (by rolling average latency, inflated by the rolling error rate) and fails over to the
+next one on a retryable API error. Endpoints whose rolling error rate is too high are only tried
+last until their cooldown expires. A small share of the requests (explore_rate) goes first to an
+endpoint whose stats are missing or out of date (never succeeded, not used for stale_secs, or
+back from a cooldown), so a faster endpoint is found and a recovered one gets traffic again.
+Callers (and the cache keys) only ever see the logical model name.
+"""
+import random
+import threading
+import time
+from typing import Dict, List, Tuple
+
+
+class Endpoint:
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        # rolling (exponentially weighted) averages; latency is None until a request succeeded.
+        self.latency_secs = None
+        self.error_rate = 0.0
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_explorations = 0
+        self.unhealthy_until = 0.0
+        # when a request to it was last recorded.
+        self.updated_at = 0.0
+
+    def is_healthy(self, now: float) -> bool:
+        return self.unhealthy_until <= now
+
+    def rank_key(self, now: float) -> Tuple:
+        """Healthy before unhealthy, measured before unmeasured (never succeeded), then by expected
+        seconds to a success: latency / (1 - error rate), every failed try costing another one."""
+        expected_secs = (self.latency_secs or 0.0) / max(1.0 - self.error_rate, 0.01)
+        return not self.is_healthy(now), self.latency_secs is None, expected_secs, self.error_rate
+
+    def needs_exploring(self, now: float, stale_secs: float, max_error_rate: float) -> bool:
+        """Healthy, but its stats do not say how it does now."""
+        return self.is_healthy(now) and (self.latency_secs is None or now - self.updated_at > stale_secs
+                                         or self.error_rate > max_error_rate)
+
+    def to_json(self) -> Dict:
+        return {"provider": self.provider, "model": self.model, "latency_secs": self.latency_secs,
+                "error_rate": self.error_rate, "num_requests": self.num_requests,
+                "num_errors": self.num_errors, "num_explorations": self.num_explorations,
+                "healthy": self.is_healthy(time.time())}
+
+
+class Router:
+    def __init__(self, smoothing: float = 0.2, max_error_rate: float = 0.5, cooldown_secs: float = 30,
+                 explore_rate: float = 0.05, stale_secs: float = 60):
+        self.smoothing = smoothing
+        self.max_error_rate = max_error_rate
+        self.cooldown_secs = cooldown_secs
+        self.explore_rate = explore_rate
+        self.stale_secs = stale_secs
+        self._random = random.Random()
+        self.routes: Dict[str, List[Endpoint]] = {}
+        self._lock = threading.Lock()
+
+    def add_route(self, logical_model: str, endpoints: List[Tuple[str, str]]):
+        with self._lock:
+            self.routes[logical_model] = [Endpoint(provider=provider, model=model) for provider, model in endpoints]
+
+    def ranked(self, logical_model: str) -> List[Endpoint]:
+        """Endpoints to try in order, see Endpoint.rank_key; with probability explore_rate an endpoint
+        that needs exploring (see Endpoint.needs_exploring) is tried first."""
+        endpoints = self.routes.get(logical_model)
+        if not endpoints:
+            return []
+        now = time.time()
+        with self._lock:
+            ranked = sorted(endpoints, key=lambda e: e.rank_key(now))
+            candidates = [e for e in ranked[1:] if e.needs_exploring(now, self.stale_secs, self.max_error_rate)]
+            if candidates and self._random.random() < self.explore_rate:
+                explored = self._random.choice(candidates)
+                explored.num_explorations += 1
+                ranked.remove(explored)
+                ranked.insert(0, explored)
+            return ranked
+
+    def record(self, endpoint: Endpoint, latency_secs: float, error: bool):
+        with self._lock:
+            endpoint.num_requests += 1
+            endpoint.updated_at = time.time()
+            endpoint.error_rate = self.smoothing * error + (1 - self.smoothing) * endpoint.error_rate
+            if error:
+                endpoint.num_errors += 1
+                if endpoint.error_rate > self.max_error_rate:
+                    endpoint.unhealthy_until = time.time() + self.cooldown_secs
+            elif endpoint.latency_secs is None:
+                endpoint.latency_secs = latency_secs
+            else:
+                endpoint.latency_secs = self.smoothing * latency_secs + (1 - self.smoothing) * endpoint.latency_secs
+
+    def stats(self) -> Dict[str, List[Dict]]:
+        with self._lock:
+            return {logical_model: [e.to_json() for e in endpoints] for logical_model, endpoints in self.routes.items()}
+
+
+# shared by every OpenaiAPIWrapper.call in the process.
+router = Router()
+
+
+def add_route(logical_model: str, endpoints: List[Tuple[str, str]]):
+    """Serves logical_model from endpoints, a list of (provider, model name at that provider)."""
+    router.add_route(logical_model, endpoints)
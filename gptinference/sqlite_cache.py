@@ -0,0 +1,80 @@
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from gptinference.caching import CacheBackend, OpenAICacheKey, OpenAICacheValue, encode_record
+
+
+class SqliteCacheBackend(CacheBackend):
+    """
+    Cache stored in an sqlite database (WAL mode), keyed by OpenAICacheKey.digest().
+    Nothing is loaded at startup; get is a primary key lookup. Several threads and
+    processes can read and write the same db_path concurrently: readers never block
+    and each flush inserts its batch in one transaction.
+    """
+
+    def __init__(self, db_path: str, save_every_n_seconds = 600,
+                 save_every_n_entries: int = 100,
+                 keep_prompts: bool = False,
+                 busy_timeout_secs: float = 60):
+        super().__init__(save_every_n_seconds=save_every_n_seconds, save_every_n_entries=save_every_n_entries)
+        assert db_path is not None, f"\n\ncaching openai: cache db is empty."
+        self.db_path: str = db_path.strip()
+        self.keep_prompts = keep_prompts
+        self.busy_timeout_secs = busy_timeout_secs
+        # sqlite connections can not be shared across threads.
+        self._local = threading.local()
+        # digest -> entries set but not yet written.
+        self._unflushed: Dict[bytes, OpenAICacheValue] = {}
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS cache (key BLOB PRIMARY KEY, record TEXT NOT NULL)")
+        conn.commit()
+        self.start()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_secs)
+            # durable at checkpoints, and much cheaper than fsync per transaction in WAL mode.
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @property
+    def num_entries(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key: OpenAICacheKey) -> Optional[OpenAICacheValue]:
+        digest = key.digest()
+        value = self._unflushed.get(digest)
+        if value is not None:
+            return value
+        row = self._conn().execute("SELECT record FROM cache WHERE key = ?", (digest,)).fetchone()
+        return OpenAICacheValue.from_json(json.loads(row[0])) if row else None
+
+    @property
+    def stores_prompts(self) -> bool:
+        return self.keep_prompts
+
+    def iter_keys(self) -> Iterator[OpenAICacheKey]:
+        for (record,) in self._conn().execute("SELECT record FROM cache"):
+            j = json.loads(record)
+            if "prompt" in j:
+                yield OpenAICacheKey.from_json(j)
+
+    def remember(self, key: OpenAICacheKey, value: OpenAICacheValue):
+        self._unflushed[key.digest()] = value
+
+    def write_batch(self, entries: List[Tuple[OpenAICacheKey, OpenAICacheValue]]) -> int:
+        rows = [(key.digest(), encode_record(key, v, hashed_keys=True, keep_prompts=self.keep_prompts).decode("utf-8"))
+                for key, v in entries]
+        conn = self._conn()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO cache (key, record) VALUES (?, ?)", rows)
+        with self._lock:
+            for (digest, _), (_, v) in zip(rows, entries):
+                if self._unflushed.get(digest) is v:
+                    del self._unflushed[digest]
+        return sum(len(digest) + len(record) for digest, record in rows)
@@ -1,12 +1,7 @@
-from openai import OpenAI
-import os
+from gptinference.openai_api import get_client
 
-TOGETHER_API_KEY = os.environ.get("TOGETHER_API_KEY")
-
-client = OpenAI(
-  api_key=TOGETHER_API_KEY,
-  base_url='https://api.together.xyz/v1',
-)
+# TOGETHER_API_KEY is read from the environment when the client is first used.
+client = get_client(provider="together")
 
 chat_completion = client.chat.completions.create(
   messages=[
@@ -22,4 +17,4 @@ chat_completion = client.chat.completions.create(
   model="mistralai/Mixtral-8x7B-Instruct-v0.1"
 )
 
-print(chat_completion.choices[0].message.content)
\ No newline at end of file
+print(chat_completion.choices[0].message.content)